@@ -4,16 +4,20 @@ from .prompts import PROMPTS
 import openai
 import asyncio
 import os 
-from typing import Optional, Union, Dict, Literal
-from pydantic import BaseModel, Field
-from typing_extensions import Literal
 from datetime import datetime
-import requests
-import boto3
-import uuid
-from botocore.exceptions import NoCredentialsError, ClientError
 import logging
-from fastapi import UploadFile
+from .llm import get_llm_client, close_llm_client
+from .search import SearchClient
+from .storage import ImageUploader
+from .persistence import PersistenceQueue
+from .database import MongoManager
+from .router import Router
+from .context import ContextBuilder
+from .metrics import StageMetrics, StageTimer
+from .batch import BatchWork, BATCH_CONCURRENCY
+from .scheduler import RequestScheduler
+from .images import ImagePreprocessor, ImageResultCache
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,113 +25,182 @@ logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
-AWS_ACCESS_KEY=os.getenv("AWS_ACCESS_KEY")
-AWS_SECRET_KEY=os.getenv("AWS_SECRET_KEY")
-
-IMAGE_EMBEDDING_URL= os.getenv("IMAGE_EMBEDDING_URL", "http://text-embedding:3002/api/v1/embedding/")
-TEXT_EMBEDDING_URL=os.getenv("TEXT_EMBEDDING_URL", "http://text-embedding:3002/api/v1/embedding/")
-
-def upload_image_to_s3(
-    image_file: Union[bytes, UploadFile],
-    bucket_name="ezshop-bucket",
-    folder="search-uploads",
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
-    region_name: str = "ap-southeast-2",
-) -> str:
-    # Nếu là UploadFile, đọc ra bytes
-    if isinstance(image_file, UploadFile):
-        image_bytes = image_file.file.read()  # sync read (nếu bên sync code)
-    elif isinstance(image_file, bytes):
-        image_bytes = image_file
-    else:
-        raise ValueError("Invalid image_file type. Must be bytes or UploadFile")
-
-    # Xác định MIME và extension
-    mime_type = 'application/octet-stream'
-    file_ext = 'bin'
-
-    if image_bytes[:4] == b'\x89PNG':
-        mime_type = 'image/png'
-        file_ext = 'png'
-    elif image_bytes[:2] == b'\xff\xd8':
-        mime_type = 'image/jpeg'
-        file_ext = 'jpg'
-    elif image_bytes[:6] in (b'GIF87a', b'GIF89a'):
-        mime_type = 'image/gif'
-        file_ext = 'gif'
-
-    filename = f"{uuid.uuid4().hex}.{file_ext}"
-    s3_key = f"{folder.rstrip('/')}/{filename}" if folder else filename
-
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=region_name,
-    )
-
-    try:
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=image_bytes,
-            ContentType=mime_type,
-            ACL="public-read",
-        )
-
-        image_url = f"https://{bucket_name}.s3.{region_name}.amazonaws.com/{s3_key}"
-        return image_url
-
-    except NoCredentialsError:
-        raise RuntimeError("AWS credentials not provided or invalid.")
-    except ClientError as e:
-        raise RuntimeError(f"Failed to upload image: {e.response['Error']['Message']}")
-
-
-    except NoCredentialsError:
-        raise RuntimeError("AWS credentials not provided or invalid.")
-    except ClientError as e:
-        raise RuntimeError(f"Failed to upload image: {e.response['Error']['Message']}")
-
-class FilterResponse(BaseModel):
-    rating_average: Optional[Dict[str, float]] = Field(
-        None, description="e.g., {'$gte': 4}", json_schema_extra={
-            "type": "object",
-            "additionalProperties": {"type": ["number", "array"]}
-        }
-    )
-    price: Optional[Dict[str, float]] = Field(
-        None, description="e.g., {'$gte': 500000, '$lte': 2000000}", json_schema_extra={
-            "type": "object",
-            "additionalProperties": {"type": ["number", "array"]}
-        }
-    )
-    review_count: Optional[Dict[str, float]] = Field(
-        None, description="e.g., {'$gte': 10}", json_schema_extra={
-            "type": "object",
-            "additionalProperties": {"type": ["number", "array"]}
-        }
-    )
 
 
-class RouterResponse(BaseModel):
-    needs_context: bool
-    intent: Optional[str] = None
-    query: Optional[str] = None
-    collection: Literal["products", "policies_FAQ", "exists"]
-    filter: Optional[FilterResponse] = None
-
 class Agent:
-    def __init__(self, model = "gpt-4.1-mini"):
-        self.chatbot = openai.OpenAI()
+    def __init__(self, model = "gpt-4.1-mini", chatbot = None):
+        self.chatbot = chatbot or get_llm_client()
         self.model = model
-        self.history = History() 
-        self.personalization = Personalization(summarizer = self.chatbot)
+        self.scheduler = RequestScheduler()
+        self.mongo = MongoManager()
+        self.history = History(mongo = self.mongo) 
+        self.personalization = Personalization(summarizer = self.chatbot, mongo = self.mongo, llm_slots = self.scheduler.llm)
+        self.router = Router(chatbot = self.chatbot, model = self.model, llm_slots = self.scheduler.llm)
+        self.search = SearchClient(slots = self.scheduler.search)
+        self.uploader = ImageUploader()
+        self.images = ImagePreprocessor()
+        self.image_cache = ImageResultCache()
+        self.metrics = StageMetrics()
+        self.persistence = PersistenceQueue(self.history, self.personalization, metrics = self.metrics)
+        self.context_builder = ContextBuilder()
+        self.batch_counters = {"batches": 0, "items": 0, "failed_items": 0, "router_shared": 0, "search_shared": 0}
+        self.stream_counters = {"abandoned": 0}
+
+    def stats(self):
+        return {
+            "router": self.router.stats(),
+            "search": self.search.stats(),
+            "persistence": self.persistence.stats(),
+            "summary_cache": self.personalization.cache.stats(),
+            "history_buffer": self.history.buffer.stats(),
+            "mongo": self.mongo.stats(),
+            "context": self.context_builder.stats(),
+            "stages": self.metrics.stats(),
+            "batch": self.batch_counters,
+            "stream": self.stream_counters,
+            "scheduler": self.scheduler.stats(),
+            "images": self.images.stats(),
+            "image_cache": self.image_cache.stats(),
+        }
+
+    async def start(self):
+        await self.mongo.start()
+        # Index chỉ tạo một lần lúc startup
+        await asyncio.gather(self.history.ensure_indexes(), self.personalization.ensure_indexes())
+        self.persistence.start()
+
+    async def close(self):
+        await self.persistence.close()
+        await self.uploader.close()
+        await self.search.close()
+        await self.mongo.close()
+        await close_llm_client()
+
+    async def get_response(self, user_id, input_data, batch = None):
+        # Overloaded -> 429; tin nhắn của cùng một user chạy tuần tự.
+        # Item của batch đã được admit cùng batch: chỉ giữ lock của user, không bị shed
+        admission = self.scheduler.user_lock(user_id) if batch is not None else self.scheduler.admit(user_id)
+        async with admission:
+            timer = StageTimer(self.metrics)
+            turn = await self._retrieve(user_id, input_data, timer, batch)
+
+            with timer.stage("llm_answer"):
+                async with self.scheduler.llm.slot():
+                    final_completion = await self.chatbot.chat.completions.create(
+                        model=self.model,
+                        messages=self._answer_messages(turn)
+                    )
+            final_response = final_completion.choices[0].message.content
+
+            return await self._finish(user_id, input_data, turn, final_response)
+
+    async def stream_response(self, user_id, input_data):
+        """
+        Yield {"event", "data"} dicts: "products" as soon as retrieval is done,
+        one "token" per answer delta, then "done" with the final response_data.
+        History and summary are written after the answer stream completes; a stream that is
+        closed early (client disconnect -> aclose()) releases its slots and is logged, not saved.
+        """
+        chunks = []
+        finished = False
+        try:
+            async with self.scheduler.admit(user_id):
+                timer = StageTimer(self.metrics)
+                turn = await self._retrieve(user_id, input_data, timer)
+                yield {
+                    "event": "products",
+                    "data": {"products": turn["products"], "image": turn["image_url"]},
+                }
 
-    async def get_response(self, user_id, input_data):
-        history_task = self.history.retrieve_history(user_id=user_id, look_back=5)
-        summary_task = self.personalization.retrieve_user_summary(user_id)
+                llm_start = time.perf_counter()
+                # Giữ LLM slot đến hết stream: request vẫn đang chạy phía OpenAI
+                async with self.scheduler.llm.slot():
+                    stream = await self.chatbot.chat.completions.create(
+                        model=self.model,
+                        messages=self._answer_messages(turn),
+                        stream=True
+                    )
+                    try:
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                if not chunks:
+                                    timer.record("llm_first_token", time.perf_counter() - llm_start)
+                                chunks.append(delta)
+                                yield {"event": "token", "data": delta}
+                    finally:
+                        # Đóng HTTP stream tới OpenAI ngay, không chờ GC
+                        await stream.close()
+                timer.record("llm_answer", time.perf_counter() - llm_start)
+
+                response_data = await self._finish(user_id, input_data, turn, "".join(chunks))
+                finished = True
+                yield {"event": "done", "data": response_data}
+        finally:
+            if not finished:
+                self.stream_counters["abandoned"] += 1
+                logger.warning(
+                    f"Stream for user {user_id} closed before completion after {len(chunks)} chunks; "
+                    f"turn not saved (query: {input_data.get('query')!r})"
+                )
+
+    async def run_batch(self, items, concurrency = BATCH_CONCURRENCY, timings = False):
+        """
+        Answer many {"user_id", "conversation_id", "text"} items with at most `concurrency`
+        in flight, sharing identical router/search work inside the batch.
+        Yields one result per item in completion order; a failed item does not stop the batch.
+        The batch is admitted once (Overloaded on the first iteration); its items are never shed.
+        """
+        async with self.scheduler.admit_batch():
+            async for result in self._run_batch(items, concurrency, timings):
+                yield result
+
+    async def _run_batch(self, items, concurrency, timings):
+        batch = BatchWork()
+        semaphore = asyncio.Semaphore(concurrency)
+        results = asyncio.Queue()
+
+        async def run_item(index, item):
+            result = {"index": index, "conversation_id": item.get("conversation_id"), "user_id": item["user_id"]}
+            try:
+                async with semaphore:
+                    response = await self.get_response(
+                        item["user_id"], {"query": item["text"], "timings": timings}, batch = batch
+                    )
+                result.update(status = "success", response = response)
+            except Exception as e:
+                logger.error(f"Batch item {index} failed for user {item['user_id']}: {str(e)}")
+                self.batch_counters["failed_items"] += 1
+                result.update(status = "error", error = "Internal server error")
+            await results.put(result)
+
+        self.batch_counters["batches"] += 1
+        self.batch_counters["items"] += len(items)
+        tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
+        try:
+            for _ in tasks:
+                yield await results.get()
+        finally:
+            # Client ngắt kết nối giữa chừng -> huỷ các item còn lại
+            for task in tasks:
+                task.cancel()
+            work = batch.stats()
+            self.batch_counters["router_shared"] += work["router_shared"]
+            self.batch_counters["search_shared"] += work["search_shared"]
+            logger.info(f"Batch of {len(items)} items finished: {work}")
+
+    def _answer_messages(self, turn):
+        return [
+            {"role": "system", "content": PROMPTS.AGENT_PROMPT},
+            {"role": "user", "content": turn["context"]}
+        ]
+
+    async def _retrieve(self, user_id, input_data, timer = None, batch = None):
+        timer = timer or StageTimer(self.metrics)
+        history_task = timer.timed("history_fetch", self.history.retrieve_history(user_id=user_id, look_back=5))
+        summary_task = timer.timed("summary_fetch", self.personalization.retrieve_user_summary(user_id))
         past_convo_response, user_summary_response = await asyncio.gather(history_task, summary_task)
 
         past_convo_result = past_convo_response.model_dump()
@@ -147,14 +220,8 @@ class Agent:
         else:
             user_summary = {"personal_info": [], "preferences": []}
 
-        # print("Building router message")
-        router_message = f"Past conversations: {chat_history}\nUser summary: {user_summary}\n"
-        if input_data.get("query"):
-            router_message += f"User query: {input_data['query']}"
-
-        # print(router_message)
-
         image_url = ''
+        upload_task = None
         product_results=[]
 
         if input_data.get("image"):
@@ -169,58 +236,106 @@ class Agent:
                 else:
                     image_bytes = image
 
-                files = {
-                    "image": ("image.jpg", image_bytes, "image/jpeg")
-                }
-                product_results = requests.post(IMAGE_EMBEDDING_URL, files=files).json()
+                digest = self.image_cache.digest(image_bytes)
+                cached = self.image_cache.get(digest)
+                if cached is not None and cached["url"]:
+                    # Ảnh đã gửi trước đó: bỏ qua decode, search và upload
+                    product_results = cached["products"]
+                    image_url = cached["url"]
+                else:
+                    # Decode một lần: bản nhỏ cho embedding, bản giới hạn độ phân giải cho S3
+                    with timer.stage("image_preprocess"):
+                        processed = await self.images.process(image_bytes)
+
+                    # URL được tạo trước từ key (hash nội dung), upload chạy song song với search + LLM
+                    upload = self.uploader.prepare(processed.store_bytes, name = digest)
+                    image_url = upload.url
+                    upload_started = time.perf_counter()
+                    upload_task = scheduled = self.uploader.schedule(processed.store_bytes, upload)
+
+                    def upload_done(task, url = upload.url):
+                        # Ghi thời gian upload khi task xong, kể cả ở chế độ background
+                        timer.record("s3_upload", time.perf_counter() - upload_started)
+                        if not task.cancelled() and task.exception() is None:
+                            self.image_cache.mark_uploaded(digest, url)
+
+                    scheduled.add_done_callback(upload_done)
+                    if self.uploader.background:
+                        upload_task = None
+
+                    if cached is not None:
+                        # Upload lần trước chưa xong/thất bại: chỉ upload lại, kết quả search lấy từ cache
+                        product_results = cached["products"]
+                    else:
+                        search_result = await self.search.search_image(processed.embed_bytes)
+                        timer.record("search_image", search_result.latency)
+                        if search_result.status != "success":
+                            logger.warning(f"Image search failed for user {user_id}: {search_result.error}")
+                        product_results = search_result.products()
+                        if search_result.status == "success" and product_results:
+                            # Upload có thể đã xong trước khi search trả về
+                            finished = scheduled.done() and not scheduled.cancelled() and scheduled.exception() is None
+                            uploaded = upload.url if finished else None
+                            self.image_cache.put(
+                                digest, product_results, len(processed.embed_bytes), len(processed.store_bytes), url = uploaded
+                            )
 
-                image_url = upload_image_to_s3(image_bytes)
                 # print("\nProduct results:", product_results)
                 # print("Image URL:", image_url)
-                product_results = product_results.get("top_k_results", [])
-                # print("\nProduct results:", product_results)
-                full_context_query = f"User's intent: {input_data.get("query", "Tìm sản phẩm bằng hình")}\nUser Preferences:{user_summary}\nRelevant products:{str(product_results)}\nRecent Conversations:{chat_history}"
+                full_context_query = self.context_builder.build(
+                    input_data.get("query") or "Tìm sản phẩm bằng hình", user_summary, product_results, chat_history
+                )
                 # print("Full context query:", full_context_query)
         else:
             print("On text track")
             # logger.info(RouterResponse.model_json_schema())
-            results = self.chatbot.beta.chat.completions.parse(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": PROMPTS.TEXT_PROMPT},
-                    {"role": "user", "content": router_message}
-                ],
-                response_format = RouterResponse
-            ).choices[0].message.parsed
-            full_context_query = f"User's intent: {results.intent}\nUser Preferences:\n{user_summary}\nRecent Conversations:\n{chat_history}"
+            with timer.stage("router"):
+                if batch is not None:
+                    results = await batch.route(self.router, input_data.get("query"), chat_history, user_summary)
+                else:
+                    results = await self.router.route(input_data.get("query"), chat_history, user_summary)
             # logger.info(f"Router results: {results}")
             if results.intent:
                 logger.info("User needs context")
-                body = {
-                    'query':results.query,
-                    'filter':results.filter.model_dump() if results.filter else {}
-                }
+                search_filter = results.filter.model_dump(exclude_none=True) if results.filter else {}
+                if batch is not None:
+                    search_result, shared = await batch.search_products(self.search, results.query, search_filter)
+                else:
+                    search_result, shared = await self.search.search_products(results.query, filter=search_filter), False
+                product_results = search_result.products()
+                # Kết quả dùng chung trong batch chỉ được tính giờ một lần
+                if not shared:
+                    for stage, seconds in search_result.stages.items():
+                        timer.record(stage, seconds)
+                if search_result.fallback_used:
+                    logger.info(f"Filter {search_filter} matched nothing, answered with unfiltered results")
 
-                product_results = requests.post(TEXT_EMBEDDING_URL, json=body).json()
-                product_results = product_results.get("top_k_results", [])
-
-                if not product_results:
-                    logger.info("Empty search result. Proceed to search again, no filter...")
-                    body = {
-                        'query':results.query
-                    }
-                    product_results = requests.post(TEXT_EMBEDDING_URL, json=body).json()
-                    product_results = product_results.get("top_k_results", [])
-
-                full_context_query += f"\nRelevant products:{str(product_results)}"
-
-        final_response = self.chatbot.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": PROMPTS.AGENT_PROMPT},
-                {"role": "user", "content": full_context_query}
-            ]
-        ).choices[0].message.content
+                if search_result.status != "success":
+                    logger.warning(f"Text search failed for user {user_id}: {search_result.error}")
+
+            full_context_query = self.context_builder.build(results.intent, user_summary, product_results, chat_history)
+
+        return {
+            "context": full_context_query,
+            "products": product_results,
+            "image_url": image_url,
+            "upload_task": upload_task,
+            "timer": timer,
+        }
+
+    async def _finish(self, user_id, input_data, turn, final_response):
+        image_url = turn["image_url"]
+        product_results = turn["products"]
+        upload_task = turn["upload_task"]
+        timer = turn["timer"]
+        if upload_task is not None:
+            try:
+                with timer.stage("s3_upload_wait"):
+                    await upload_task
+            except Exception as e:
+                # Câu trả lời đã có: upload lỗi chỉ bỏ URL ảnh, không biến request thành 500
+                logger.error(f"Image upload failed for user {user_id}: {str(e)}")
+                image_url = ''
         logger.info(f"Product to respond: {product_results}")
         response_data = {
             "user_id": user_id,
@@ -228,21 +343,21 @@ class Agent:
             "image": image_url,
             "response": final_response,
             "products": product_results, 
-            "context": full_context_query,
+            "context": turn["context"],
             "timestamp": datetime.now().isoformat(),
         }
 
-        history_task = self.history.add_to_history(user_id, response_data)
-        summary_task = self.personalization.update_user_summary(user_id, response_data)
-        save_history_response, update_summary_response = await asyncio.gather(history_task, summary_task)
+        # History + summary được ghi nền (write-behind), không chặn response
+        with timer.stage("persistence"):
+            await self.persistence.submit(user_id, response_data)
 
-        if update_summary_response.status != "success" or save_history_response.status != "success":
-            logger.warning(f"Failed to update user summary for user {user_id}: {update_summary_response.error}")
-            logger.warning(f"Failed to save history for user {user_id}: {save_history_response.error}")
-        
         response_data.pop("_id", None)
         response_data.pop("context", None)
 
+        timer.record("total", timer.elapsed())
+        if input_data.get("timings"):
+            response_data["timings"] = timer.as_dict()
+
         return response_data
 
 
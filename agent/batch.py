@@ -0,0 +1,66 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from .router import normalize_query, context_hash
+
+logger = logging.getLogger(__name__)
+
+'''
+class SingleFlight
+Memoizes coroutine results by key: the first caller runs the work, concurrent and
+later callers with the same key await the same future.
+
+class BatchWork
+Per-batch dedup scope passed through Agent.get_response(..., batch=...).
++ route(): keyed by (normalized query, hash of history + summary)
++ search_products(): keyed by (query, filter)
+Results live only as long as the batch, so nothing is shared across batches.
+'''
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.counters = {"calls": 0, "shared": 0}
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True when another caller did the work."""
+        future = self.calls.get(key)
+        shared = future is not None
+        if shared:
+            self.counters["shared"] += 1
+        else:
+            future = self.calls[key] = asyncio.ensure_future(work())
+            self.counters["calls"] += 1
+        # shield: một item bị huỷ không huỷ kết quả dùng chung
+        return await asyncio.shield(future), shared
+
+
+class BatchWork:
+    def __init__(self):
+        self.router = SingleFlight()
+        self.search = SingleFlight()
+
+    async def route(self, router, query, chat_history, user_summary):
+        key = (normalize_query(query), context_hash(chat_history, user_summary))
+        result, _ = await self.router.run(key, lambda: router.route(query, chat_history, user_summary))
+        return result
+
+    async def search_products(self, search, query, filter):
+        key = (query, json.dumps(filter, sort_keys=True, default=str))
+        return await self.search.run(key, lambda: search.search_products(query, filter=filter))
+
+    def stats(self) -> Dict:
+        return {
+            "router_calls": self.router.counters["calls"],
+            "router_shared": self.router.counters["shared"],
+            "search_calls": self.search.counters["calls"],
+            "search_shared": self.search.counters["shared"],
+        }
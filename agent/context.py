@@ -0,0 +1,154 @@
+import os
+import math
+import logging
+from typing import Dict, List, Optional, Union
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a byte-length estimate
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+'''
+class ContextBuilder
+Builds the user message for AGENT_PROMPT within a token budget.
++ products: deduped by database_id, only the fields the answer needs, one compact line each
++ history: rendered oldest -> newest, oldest turns dropped first when over budget
++ summary: personal_info / preferences as short lists
+'''
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_PRODUCTS = int(os.getenv("CONTEXT_MAX_PRODUCTS", "10"))
+CONTEXT_FIELD_CHARS = int(os.getenv("CONTEXT_FIELD_CHARS", "300"))
+CONTEXT_TURN_CHARS = int(os.getenv("CONTEXT_TURN_CHARS", "600"))
+CONTEXT_SUMMARY_ITEMS = int(os.getenv("CONTEXT_SUMMARY_ITEMS", "10"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "o200k_base")
+
+# (field in search result, label in prompt)
+PRODUCT_FIELDS = [
+    ("description", "mô tả"),
+    ("benefits", "lợi ích"),
+    ("specifications", "thông số"),
+]
+
+
+def shorten(text, limit: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        max_products: int = CONTEXT_MAX_PRODUCTS,
+        field_chars: int = CONTEXT_FIELD_CHARS,
+        turn_chars: int = CONTEXT_TURN_CHARS,
+        summary_items: int = CONTEXT_SUMMARY_ITEMS,
+        tokenizer: str = CONTEXT_TOKENIZER,
+    ):
+        self.token_budget = token_budget
+        self.max_products = max_products
+        self.field_chars = field_chars
+        self.turn_chars = turn_chars
+        self.summary_items = summary_items
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding(tokenizer)
+            except Exception as e:
+                logger.warning(f"Tokenizer {tokenizer} unavailable, estimating tokens: {str(e)}")
+        self.counters = {"builds": 0, "tokens": 0, "over_budget": 0, "dropped_turns": 0, "dropped_products": 0, "duplicate_products": 0}
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return math.ceil(len(text.encode("utf-8")) / 4)
+
+    def format_summary(self, user_summary: Union[Dict, List, str]) -> List[str]:
+        if not isinstance(user_summary, dict):
+            return [shorten(user_summary, self.turn_chars)] if user_summary else []
+        lines = []
+        for key in ("personal_info", "preferences"):
+            items = [shorten(item, 120) for item in (user_summary.get(key) or [])[:self.summary_items]]
+            if items:
+                lines.append(f"- {key}: " + "; ".join(items))
+        return lines
+
+    def format_products(self, products: List[Dict]) -> List[str]:
+        lines, seen = [], set()
+        for product in products:
+            key = product.get("database_id") or product.get("name")
+            if key in seen:
+                self.counters["duplicate_products"] += 1
+                continue
+            seen.add(key)
+            parts = [f"[id={product.get('database_id')}] {shorten(product.get('name') or '', 150)}"]
+            if product.get("price") is not None:
+                parts.append(f"giá: {product['price']}")
+            for field, label in PRODUCT_FIELDS:
+                if product.get(field):
+                    parts.append(f"{label}: {shorten(product[field], self.field_chars)}")
+            lines.append(" | ".join(parts))
+        if len(lines) > self.max_products:
+            self.counters["dropped_products"] += len(lines) - self.max_products
+            lines = lines[:self.max_products]
+        return lines
+
+    def format_history(self, chat_history: List) -> List[str]:
+        """chat_history is newest first (as retrieved); output is oldest first."""
+        turns = []
+        for turn in chat_history:
+            if isinstance(turn, (list, tuple)) and len(turn) == 2:
+                user_query, response = turn
+                turns.append(f"User: {shorten(user_query or '', self.turn_chars)}\nAssistant: {shorten(response or '', self.turn_chars)}")
+        return list(reversed(turns))
+
+    def render(self, intent: str, summary_lines: List[str], product_lines: List[str], history_lines: List[str]) -> str:
+        sections = [f"User's intent: {intent}"]
+        sections.append("User Preferences:\n" + ("\n".join(summary_lines) if summary_lines else "- none"))
+        if product_lines:
+            sections.append("Relevant products:\n" + "\n".join(f"{i}. {line}" for i, line in enumerate(product_lines, 1)))
+        sections.append("Recent Conversations:\n" + ("\n".join(history_lines) if history_lines else "No past conversations found."))
+        return "\n".join(sections)
+
+    def build(
+        self,
+        intent: Optional[str],
+        user_summary: Union[Dict, List, str],
+        products: Optional[List[Dict]] = None,
+        chat_history: Optional[List] = None,
+    ) -> str:
+        summary_lines = self.format_summary(user_summary)
+        product_lines = self.format_products(products or [])
+        history_lines = self.format_history(chat_history or [])
+
+        context = self.render(intent, summary_lines, product_lines, history_lines)
+        tokens = self.count_tokens(context)
+        # Bỏ turn cũ nhất trước, sau đó mới bỏ sản phẩm xếp hạng thấp nhất (giữ ít nhất 1)
+        while tokens > self.token_budget and (history_lines or len(product_lines) > 1):
+            if history_lines:
+                history_lines.pop(0)
+                self.counters["dropped_turns"] += 1
+            else:
+                product_lines.pop()
+                self.counters["dropped_products"] += 1
+            context = self.render(intent, summary_lines, product_lines, history_lines)
+            tokens = self.count_tokens(context)
+
+        self.counters["builds"] += 1
+        self.counters["tokens"] += tokens
+        if tokens > self.token_budget:
+            self.counters["over_budget"] += 1
+            logger.warning(f"Context still {tokens} tokens after trimming (budget {self.token_budget})")
+        return context
+
+    def stats(self) -> Dict:
+        builds = self.counters["builds"]
+        return {
+            **self.counters,
+            "token_budget": self.token_budget,
+            "avg_tokens": self.counters["tokens"] / builds if builds else 0.0,
+            "exact_tokenizer": self.encoding is not None,
+        }
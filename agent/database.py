@@ -0,0 +1,138 @@
+import logging
+import threading
+from os import getenv
+from typing import Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import monitoring
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+'''
+class MongoManager
+One pooled AsyncIOMotorClient per process, shared by History and Personalization.
++ start(): create the client (FastAPI lifespan); indexes are created once by the owners
++ get_collection(db, collection)
++ stats(): pool size and checkout metrics from a pymongo ConnectionPoolListener
++ close()
+'''
+
+MONGO_USER = getenv("MONGO_USER")
+MONGO_PASSWORD = getenv("MONGO_PASSWORD")
+CONNECTION_STRING = getenv("CONNECTION_STRING")
+URI = f"mongodb+srv://{MONGO_USER}:{MONGO_PASSWORD}@{CONNECTION_STRING}"
+MONGO_MAX_POOL_SIZE = int(getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts connections and checkouts; pymongo calls these from its own threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "checked_out": 0,
+            "max_checked_out": 0,
+            "pool_cleared": 0,
+        }
+
+    def _add(self, key: str, value: int = 1):
+        with self.lock:
+            self.counters[key] += value
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failures")
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.counters["checkouts"] += 1
+            self.counters["checked_out"] += 1
+            self.counters["max_checked_out"] = max(self.counters["max_checked_out"], self.counters["checked_out"])
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            counters = dict(self.counters)
+        counters["open_connections"] = counters["connections_created"] - counters["connections_closed"]
+        return counters
+
+
+class MongoManager:
+    def __init__(
+        self,
+        uri: str = URI,
+        max_pool_size: int = MONGO_MAX_POOL_SIZE,
+        min_pool_size: int = MONGO_MIN_POOL_SIZE,
+        server_selection_timeout_ms: int = MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        client=None,
+    ):
+        self.uri = uri
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.metrics = PoolMetrics()
+        self.client: Optional[AsyncIOMotorClient] = client
+
+    async def start(self):
+        self.get_client()
+        logger.info(f"MongoDB (Motor) client ready (maxPoolSize={self.max_pool_size})")
+
+    def get_client(self) -> AsyncIOMotorClient:
+        if self.client is None:
+            self.client = AsyncIOMotorClient(
+                self.uri,
+                maxPoolSize=self.max_pool_size,
+                minPoolSize=self.min_pool_size,
+                serverSelectionTimeoutMS=self.server_selection_timeout_ms,
+                event_listeners=[self.metrics],
+            )
+        return self.client
+
+    def get_collection(self, db_name: str, collection_name: str) -> AsyncIOMotorCollection:
+        return self.get_client()[db_name][collection_name]
+
+    def stats(self) -> Dict:
+        return {
+            **self.metrics.snapshot(),
+            "max_pool_size": self.max_pool_size,
+            "min_pool_size": self.min_pool_size,
+        }
+
+    async def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
@@ -1,11 +1,15 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
+from bson import Binary, ObjectId
+import zlib
 import asyncio
 import logging
 from pydantic import BaseModel
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
 from os import getenv
 from dotenv import load_dotenv
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from .database import MongoManager, URI
 load_dotenv()
 
 # Configure logging
@@ -16,20 +20,31 @@ logger = logging.getLogger(__name__)
 
 HISTORY_DB = "ChatHistory"
 HISTORY_COLLECTION = "ChatHistory"
-MONGO_USER = getenv("MONGO_USER")
-MONGO_PASSWORD = getenv("MONGO_PASSWORD")
-CONNECTION_STRING = getenv("CONNECTION_STRING")
-URI = f"mongodb+srv://{MONGO_USER}:{MONGO_PASSWORD}@{CONNECTION_STRING}"
+HISTORY_BUFFER_TURNS = int(getenv("HISTORY_BUFFER_TURNS", "10"))
+HISTORY_BUFFER_MAX_BYTES = int(getenv("HISTORY_BUFFER_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_COLD_COLLECTION = getenv("HISTORY_COLD_COLLECTION", "ChatHistoryArchive")
+# cold: context + full products go to HISTORY_COLD_COLLECTION; none: they are dropped
+HISTORY_CONTEXT_STORAGE = getenv("HISTORY_CONTEXT_STORAGE", "cold").lower()
+HISTORY_COMPRESS_CONTEXT = getenv("HISTORY_COMPRESS_CONTEXT", "true").lower() in ("1", "true", "yes")
+HISTORY_MIGRATION_BATCH_SIZE = int(getenv("HISTORY_MIGRATION_BATCH_SIZE", "500"))
+DUPLICATE_KEY_ERROR = 11000
 
 '''
  class History:
 Initialization
-+ client: mongoDB client
++ mongo: shared MongoManager (one pooled client per process)
 
 Methods
 + retrieve history by user id, top 10, sort by time descending(user_id, ): search filer user id, top 10 sort by time
+  (served from the RecentHistoryBuffer when possible, Mongo only on a miss)
 + add to history (user_id, history_to_add): 
-- insert to history with timestamp
+- insert to history with timestamp, write-through to the RecentHistoryBuffer
++ record_turn / settle_turns: write-behind turns are buffered at submit time and kept
+  pending until stored, so a user's next turn always sees the previous one
+- hot document is slim: user_id, user_query, response, image, timestamp, products as [{database_id, score}]
+- context (zlib-compressed) and full products go to the cold collection under the same _id
++ retrieve_archived_turn(turn_id): read back a cold document
++ migrate_legacy_documents(): split old full-size documents into hot + cold (idempotent)
 '''
 
 class APIResponse(BaseModel):
@@ -52,39 +67,223 @@ def serialize_mongo_doc(doc):
     return doc
 def serialize_mongo_doc_sync(doc):
     return serialize_mongo_doc(doc)
+
+
+def compress_text(text: str, compress: bool = HISTORY_COMPRESS_CONTEXT):
+    if not compress or not text:
+        return text, "plain"
+    return Binary(zlib.compress(text.encode("utf-8"))), "zlib"
+
+
+def decompress_text(value, encoding: str) -> str:
+    if encoding == "zlib":
+        return zlib.decompress(bytes(value)).decode("utf-8")
+    return value
+
+
+def product_refs(products: List[Dict]) -> List[Dict]:
+    refs = []
+    for product in products or []:
+        ref = {"database_id": product.get("database_id")}
+        if product.get("score") is not None:
+            ref["score"] = product["score"]
+        refs.append(ref)
+    return refs
+
+
+def split_turn(document: Dict, context_storage: str = HISTORY_CONTEXT_STORAGE):
+    """Split a full turn into (hot, cold); cold is None when nothing is archived."""
+    turn_id = document.get("_id") or ObjectId()
+    hot = {
+        "_id": turn_id,
+        "user_id": document["user_id"],
+        "user_query": document.get("user_query"),
+        "response": document.get("response"),
+        "image": document.get("image", ""),
+        "products": product_refs(document.get("products")),
+        "timestamp": document.get("timestamp"),
+    }
+    if context_storage != "cold":
+        return hot, None
+    context, encoding = compress_text(document.get("context") or "")
+    cold = {
+        "_id": turn_id,
+        "user_id": document["user_id"],
+        "timestamp": document.get("timestamp"),
+        "context": context,
+        "context_encoding": encoding,
+        "products": document.get("products") or [],
+    }
+    return hot, cold
+
+
+async def insert_idempotent(collection, documents: List[Dict]) -> int:
+    """insert_many that treats already-stored _ids as success, so retries never duplicate."""
+    try:
+        result = await collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if e.details.get("writeConcernErrors") or any(err.get("code") != DUPLICATE_KEY_ERROR for err in errors):
+            raise
+        return len(documents) - len(errors)
+
+
+class RecentHistoryBuffer:
+    """
+    Per-user ring buffer of the last `turns` [user_query, response] pairs.
+    Users are LRU-evicted once the estimated size of all buffers exceeds `max_bytes`.
+    A user is only buffered after a full load from Mongo, so a buffered user's
+    deque always holds their most recent turns.
+    Write-behind turns are recorded at submit time and stay in `pending` until the
+    Mongo write settles; a miss-path load merges them in, since Mongo may not have them yet.
+    A load is bracketed by begin_load/end_load; if the user was written to while the
+    read was in flight, the snapshot may be older than that write and is not installed.
+    """
+
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, turns: int = HISTORY_BUFFER_TURNS, max_bytes: int = HISTORY_BUFFER_MAX_BYTES):
+        self.turns = turns
+        self.max_bytes = max_bytes
+        self.users: "OrderedDict[str, deque]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.pending: Dict[str, "OrderedDict[str, List[str]]"] = {}
+        # user_id -> [reads in flight, written since the first of them started]
+        self.loading: Dict[str, List] = {}
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "write_failures": 0, "stale_loads": 0}
+
+    def _entry_size(self, pair: List[str]) -> int:
+        return sum(len(str(part).encode("utf-8")) for part in pair) + self.ENTRY_OVERHEAD
+
+    def get(self, user_id: str, look_back: int) -> Optional[List[List[str]]]:
+        """Newest first, like the Mongo query; None on a miss."""
+        if look_back > self.turns or user_id not in self.users:
+            self.counters["misses"] += 1
+            return None
+        self.users.move_to_end(user_id)
+        self.counters["hits"] += 1
+        return list(reversed(self.users[user_id]))[:look_back]
+
+    def begin_load(self, user_id: str) -> List[Tuple[str, List[str]]]:
+        """Start a miss-path read; returns the pending turns to merge into its result."""
+        entry = self.loading.setdefault(user_id, [0, False])
+        entry[0] += 1
+        return self.pending_turns(user_id)
+
+    def end_load(self, user_id: str):
+        entry = self.loading.get(user_id)
+        if entry is not None:
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self.loading[user_id]
+
+    def _mark_written(self, user_id: str):
+        entry = self.loading.get(user_id)
+        if entry is not None:
+            entry[1] = True
+
+    def load(self, user_id: str, pairs_newest_first: List[List[str]]):
+        entry = self.loading.get(user_id)
+        if entry is not None and entry[1]:
+            # Có write xen vào lúc đang đọc Mongo: snapshot có thể cũ hơn, không nạp
+            self.counters["stale_loads"] += 1
+            return
+        self.drop(user_id)
+        buffer = deque(maxlen=self.turns)
+        for pair in reversed(pairs_newest_first[:self.turns]):
+            buffer.append(pair)
+        self.users[user_id] = buffer
+        self.sizes[user_id] = sum(self._entry_size(pair) for pair in buffer)
+        self.total_bytes += self.sizes[user_id]
+        self._evict()
+
+    def append(self, user_id: str, pair: List[str]):
+        self._mark_written(user_id)
+        buffer = self.users.get(user_id)
+        if buffer is None:
+            return
+        if len(buffer) == buffer.maxlen:
+            dropped = self._entry_size(buffer[0])
+            self.sizes[user_id] -= dropped
+            self.total_bytes -= dropped
+        buffer.append(pair)
+        added = self._entry_size(pair)
+        self.sizes[user_id] += added
+        self.total_bytes += added
+        self.users.move_to_end(user_id)
+        self._evict()
+
+    def record(self, user_id: str, turn_id: str, pair: List[str]):
+        self.pending.setdefault(user_id, OrderedDict())[turn_id] = pair
+        self.append(user_id, pair)
+
+    def settle(self, user_id: str, turn_id: str, stored: bool):
+        turns = self.pending.get(user_id)
+        if turns is None or turns.pop(turn_id, None) is None:
+            return
+        if not turns:
+            del self.pending[user_id]
+        if not stored:
+            # Ghi hỏng hẳn: bỏ buffer để lần đọc sau khớp lại với Mongo
+            self.counters["write_failures"] += 1
+            self._mark_written(user_id)
+            self.drop(user_id)
+
+    def pending_turns(self, user_id: str) -> List[Tuple[str, List[str]]]:
+        """(turn_id, pair) submitted but not yet stored, oldest first."""
+        return list(self.pending.get(user_id, {}).items())
+
+    def drop(self, user_id: str):
+        if self.users.pop(user_id, None) is not None:
+            self.total_bytes -= self.sizes.pop(user_id)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.users:
+            user_id, _ = self.users.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(user_id)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> Dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "users": len(self.users),
+            "pending_turns": sum(len(turns) for turns in self.pending.values()),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+        }
+
 class History:
-    def __init__(self, uri: str = URI):
-        try:
-            self.uri=uri
-            self.HISTORY_DB = HISTORY_DB
-            self.HISTORY_COLLECTION = HISTORY_COLLECTION
-            self.client = None
-            self.db = None
-            self.collection = None
-            logger.info("MongoDB (Motor) connection established successfully.")
-            self.ensure_indexes()
-        except Exception as e:
-            logger.error(f"Failed to initialize MongoDB connection: {str(e)}")
-            self.client = None  # Mark unusable safely
+    def __init__(self, uri: str = URI, mongo: Optional[MongoManager] = None):
+        self.HISTORY_DB = HISTORY_DB
+        self.HISTORY_COLLECTION = HISTORY_COLLECTION
+        self.HISTORY_COLD_COLLECTION = HISTORY_COLD_COLLECTION
+        self.context_storage = HISTORY_CONTEXT_STORAGE
+        self.owns_mongo = mongo is None
+        self.mongo = mongo or MongoManager(uri)
+        self.buffer = RecentHistoryBuffer()
 
     async def get_collection(self):
-        if self.client is None:
-            self.client = AsyncIOMotorClient(self.uri)
-        if self.collection is None:
-            self.db = self.client[HISTORY_DB]
-            self.collection = self.db[HISTORY_COLLECTION]
-        
-        return self.collection
+        return self.mongo.get_collection(self.HISTORY_DB, self.HISTORY_COLLECTION)
+
+    async def get_cold_collection(self):
+        return self.mongo.get_collection(self.HISTORY_DB, self.HISTORY_COLD_COLLECTION)
 
     async def close(self):
-        if self.client:
-            self.client.close()
-            self.client = None
+        if self.owns_mongo:
+            await self.mongo.close()
 
     async def ensure_indexes(self):
+        # Gọi một lần lúc startup, không gọi trong từng request
         collection = await self.get_collection()
         await collection.create_index([("user_id", 1), ("timestamp", -1)])
-        self.close()
+        if self.context_storage == "cold":
+            cold_collection = await self.get_cold_collection()
+            await cold_collection.create_index([("user_id", 1), ("timestamp", -1)])
+        logger.info("History indexes ensured")
 
     async def retrieve_history(self, user_id: str, filter: Dict = {}, look_back: int = 10) -> APIResponse:
         if not user_id:
@@ -92,14 +291,25 @@ class History:
         if look_back <= 0:
             return APIResponse(status="error", error="look_back must be a positive integer")
 
+        use_buffer = not filter
+        pending = []
+        if use_buffer:
+            buffered = self.buffer.get(user_id, look_back)
+            if buffered is not None:
+                return APIResponse(status="success", data={"history": buffered})
+            # Lấy trước khi đọc: turn đã submit nhưng có thể chưa nằm trong kết quả find
+            pending = self.buffer.begin_load(user_id)
+
         try:
             query_filter = {"user_id": user_id}
             query_filter.update(filter)
+            # Miss: đọc đủ K turn gần nhất để nạp buffer
+            limit = max(look_back, self.buffer.turns) if use_buffer else look_back
             
-            collection = await self.ensure_indexes()
-            projection = {"user_query": 1, "response": 1, "_id": 0, "created_at":0, "updated_at":0}
-            cursor = collection.find(query_filter, projection).sort("timestamp", -1).limit(look_back)
-            history_list = await cursor.to_list(length=look_back)
+            collection = await self.get_collection()
+            projection = {"user_query": 1, "response": 1}
+            cursor = collection.find(query_filter, projection).sort("timestamp", -1).limit(limit)
+            history_list = await cursor.to_list(length=limit)
 
             # logger.info(f"History raw: {history_list}")
             
@@ -109,11 +319,18 @@ class History:
                 for doc in history_list
             ])
 
+            stored_ids = {history.get("_id") for history in history_list}
             history_list = [
                 [history["user_query"], history["response"]]
                 for history in history_list
                 if "user_query" in history and "response" in history
             ]
+            unsaved = [pair for turn_id, pair in reversed(pending) if turn_id not in stored_ids]
+            history_list = unsaved + history_list
+
+            if use_buffer:
+                self.buffer.load(user_id, history_list)
+            history_list = history_list[:look_back]
 
             logger.info(f"Retrieved {len(history_list)} history entries for user {user_id}")
             return APIResponse(status="success", data={"history": history_list})
@@ -121,6 +338,9 @@ class History:
         except Exception as e:
             logger.error(f"Error retrieving history for user {user_id}: {str(e)}")
             return APIResponse(status="error", error="Failed to retrieve chat history")
+        finally:
+            if use_buffer:
+                self.buffer.end_load(user_id)
 
     async def add_to_history(self, user_id: str, response_data: Dict) -> APIResponse:
         if not user_id:
@@ -129,13 +349,13 @@ class History:
             return APIResponse(status="error", error="response_data must be a non-empty dictionary")
 
         try:
-            required_fields = ["user_id", "user_query", "response", "context", "timestamp"]
+            required_fields = ["user_id", "user_query", "response", "timestamp"]
             missing_fields = [f for f in required_fields if f not in response_data]
             if missing_fields:
                 return APIResponse(status="error", error=f"Missing required fields: {', '.join(missing_fields)}")
 
-            collection = await self.get_collection()
-            await collection.insert_one(response_data)
+            await self._store([response_data])
+            self.buffer.append(user_id, [response_data["user_query"], response_data["response"]])
 
             logger.info(f"History saved successfully for user {user_id}")
 
@@ -144,3 +364,96 @@ class History:
         except Exception as e:
             logger.error(f"Error saving history for user {user_id}: {str(e)}")
             return APIResponse(status="error", error="Failed to save chat history")
+
+    def record_turn(self, document: Dict):
+        """Make a write-behind turn readable now; assigns the _id it will be stored under."""
+        document.setdefault("_id", ObjectId())
+        self.buffer.record(document["user_id"], str(document["_id"]), [document["user_query"], document["response"]])
+
+    def settle_turns(self, documents: List[Dict], stored: bool):
+        for document in documents:
+            self.buffer.settle(document["user_id"], str(document["_id"]), stored)
+
+    async def add_many_to_history(self, documents: List[Dict], update_buffer: bool = True) -> APIResponse:
+        if not documents:
+            return APIResponse(status="error", error="documents cannot be empty")
+
+        try:
+            required_fields = ["user_id", "user_query", "response", "timestamp"]
+            for document in documents:
+                missing_fields = [f for f in required_fields if f not in document]
+                if missing_fields:
+                    return APIResponse(status="error", error=f"Missing required fields: {', '.join(missing_fields)}")
+
+            inserted = await self._store(documents)
+            if update_buffer:
+                for document in documents:
+                    self.buffer.append(document["user_id"], [document["user_query"], document["response"]])
+
+            logger.info(f"Saved {inserted} history documents")
+
+            return APIResponse(status="success", data={"inserted": inserted})
+
+        except Exception as e:
+            logger.error(f"Error saving {len(documents)} history documents: {str(e)}")
+            return APIResponse(status="error", error="Failed to save chat history")
+
+    async def _store(self, documents: List[Dict]) -> int:
+        # _id gán trước trên document gốc để retry không tạo bản ghi trùng
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        pairs = [split_turn(document, self.context_storage) for document in documents]
+        collection = await self.get_collection()
+        inserted = await insert_idempotent(collection, [hot for hot, _ in pairs])
+        cold_documents = [cold for _, cold in pairs if cold is not None]
+        if cold_documents:
+            cold_collection = await self.get_cold_collection()
+            await insert_idempotent(cold_collection, cold_documents)
+        return inserted
+
+    async def retrieve_archived_turn(self, turn_id: str) -> APIResponse:
+        try:
+            cold_collection = await self.get_cold_collection()
+            document = await cold_collection.find_one({"_id": ObjectId(turn_id)})
+            if document is None:
+                return APIResponse(status="error", error="Archived turn not found")
+            document["context"] = decompress_text(document.get("context"), document.pop("context_encoding", "plain"))
+            return APIResponse(status="success", data=serialize_mongo_doc(document))
+        except Exception as e:
+            logger.error(f"Error retrieving archived turn {turn_id}: {str(e)}")
+            return APIResponse(status="error", error="Failed to retrieve archived turn")
+
+    async def migrate_legacy_documents(self, batch_size: int = HISTORY_MIGRATION_BATCH_SIZE) -> APIResponse:
+        """
+        Move context and full product dicts out of old hot documents.
+        Safe to re-run: cold documents are upserted and hot documents are only matched
+        while they still carry a context field or full products.
+        """
+        legacy_filter = {"$or": [{"context": {"$exists": True}}, {"products.name": {"$exists": True}}]}
+        migrated = 0
+        try:
+            collection = await self.get_collection()
+            cold_collection = await self.get_cold_collection()
+            while True:
+                documents = await collection.find(legacy_filter).limit(batch_size).to_list(length=batch_size)
+                if not documents:
+                    break
+                hot_updates, cold_writes = [], []
+                for document in documents:
+                    hot, cold = split_turn(document, self.context_storage)
+                    hot_updates.append(UpdateOne(
+                        {"_id": document["_id"]},
+                        {"$set": {"products": hot["products"]}, "$unset": {"context": ""}},
+                    ))
+                    if cold is not None:
+                        cold_writes.append(ReplaceOne({"_id": cold["_id"]}, cold, upsert=True))
+                # Ghi cold trước, hot sau: nếu dừng giữa chừng thì lần chạy sau làm lại batch này
+                if cold_writes:
+                    await cold_collection.bulk_write(cold_writes, ordered=False)
+                await collection.bulk_write(hot_updates, ordered=False)
+                migrated += len(documents)
+                logger.info(f"Migrated {migrated} legacy history documents")
+            return APIResponse(status="success", data={"migrated": migrated})
+        except Exception as e:
+            logger.error(f"History migration stopped after {migrated} documents: {str(e)}")
+            return APIResponse(status="error", error=f"Migration stopped after {migrated} documents", data={"migrated": migrated})
@@ -0,0 +1,183 @@
+import io
+import os
+import time
+import hashlib
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+'''
+class ImagePreprocessor
+Validates an uploaded image and decodes it once (in a worker thread) into:
++ embed copy: small JPEG for the embedding service (CLIP resizes to 224x224 anyway)
++ store copy: bounded-resolution JPEG for S3 (the original bytes when already small enough)
+Invalid input raises ValueError, which the API maps to 400.
+
+class ImageResultCache
+Content-addressed (sha256 of the uploaded bytes) cache of image search results and
+the S3 URL, so a re-sent photo skips preprocessing, the embedding search and the upload.
+The digest is also the S3 object name, so repeats never create new objects.
+'''
+
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40_000_000)))
+IMAGE_ALLOWED_FORMATS = os.getenv("IMAGE_ALLOWED_FORMATS", "JPEG,PNG,WEBP,GIF").upper().split(",")
+IMAGE_EMBED_MAX_SIDE = int(os.getenv("IMAGE_EMBED_MAX_SIDE", "448"))
+IMAGE_EMBED_QUALITY = int(os.getenv("IMAGE_EMBED_QUALITY", "90"))
+IMAGE_STORE_MAX_SIDE = int(os.getenv("IMAGE_STORE_MAX_SIDE", "1280"))
+IMAGE_STORE_QUALITY = int(os.getenv("IMAGE_STORE_QUALITY", "85"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "3600"))
+
+
+class ProcessedImage(BaseModel):
+    width: int
+    height: int
+    original_bytes: int
+    embed_bytes: bytes
+    store_bytes: bytes
+
+
+class ImagePreprocessor:
+    def __init__(
+        self,
+        max_bytes: int = IMAGE_MAX_BYTES,
+        max_pixels: int = IMAGE_MAX_PIXELS,
+        allowed_formats=IMAGE_ALLOWED_FORMATS,
+        embed_max_side: int = IMAGE_EMBED_MAX_SIDE,
+        embed_quality: int = IMAGE_EMBED_QUALITY,
+        store_max_side: int = IMAGE_STORE_MAX_SIDE,
+        store_quality: int = IMAGE_STORE_QUALITY,
+    ):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.allowed_formats = set(allowed_formats)
+        self.embed_max_side = embed_max_side
+        self.embed_quality = embed_quality
+        self.store_max_side = store_max_side
+        self.store_quality = store_quality
+        self.counters = {
+            "processed": 0,
+            "rejected": 0,
+            "bytes_in": 0,
+            "bytes_embed": 0,
+            "bytes_store": 0,
+            "stored_original": 0,
+            "process_time": 0.0,
+        }
+
+    async def process(self, image_bytes: bytes) -> ProcessedImage:
+        return await asyncio.to_thread(self.preprocess, image_bytes)
+
+    def preprocess(self, image_bytes: bytes) -> ProcessedImage:
+        start_time = time.perf_counter()
+        try:
+            image, image_format = self._decode(image_bytes)
+        except ValueError:
+            self.counters["rejected"] += 1
+            raise
+
+        embed_bytes = self._encode(image, self.embed_max_side, self.embed_quality)
+        # Ảnh gốc đã là JPEG đủ nhỏ -> giữ nguyên, tránh nén lại mất chất lượng
+        if image_format == "JPEG" and max(image.size) <= self.store_max_side:
+            store_bytes = image_bytes
+            self.counters["stored_original"] += 1
+        else:
+            store_bytes = self._encode(image, self.store_max_side, self.store_quality)
+
+        self.counters["processed"] += 1
+        self.counters["bytes_in"] += len(image_bytes)
+        self.counters["bytes_embed"] += len(embed_bytes)
+        self.counters["bytes_store"] += len(store_bytes)
+        self.counters["process_time"] += time.perf_counter() - start_time
+        return ProcessedImage(
+            width=image.width,
+            height=image.height,
+            original_bytes=len(image_bytes),
+            embed_bytes=embed_bytes,
+            store_bytes=store_bytes,
+        )
+
+    def _decode(self, image_bytes: bytes):
+        if not image_bytes:
+            raise ValueError("Image is empty")
+        if len(image_bytes) > self.max_bytes:
+            raise ValueError(f"Image is larger than {self.max_bytes // (1024 * 1024)} MB")
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+            raise ValueError("Unsupported or corrupted image")
+        if image.format not in self.allowed_formats:
+            raise ValueError(f"Unsupported image type: {image.format}")
+        # Kiểm tra kích thước từ header trước khi decode (chống decompression bomb)
+        if image.width * image.height > self.max_pixels:
+            raise ValueError(f"Image resolution {image.width}x{image.height} is too large")
+        image_format = image.format
+        try:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"Failed to decode image: {str(e)}")
+        return image, image_format
+
+    def _encode(self, image: Image.Image, max_side: int, quality: int) -> bytes:
+        if max(image.size) > max_side:
+            image = image.copy()
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    def stats(self) -> Dict:
+        processed = self.counters["processed"]
+        return {
+            **self.counters,
+            "avg_process_time": self.counters["process_time"] / processed if processed else 0.0,
+            "embed_ratio": self.counters["bytes_embed"] / self.counters["bytes_in"] if self.counters["bytes_in"] else 0.0,
+            "store_ratio": self.counters["bytes_store"] / self.counters["bytes_in"] if self.counters["bytes_in"] else 0.0,
+        }
+
+
+class ImageResultCache:
+    def __init__(self, maxsize: int = IMAGE_CACHE_SIZE, ttl: float = IMAGE_CACHE_TTL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.counters = {"searches_skipped": 0, "uploads_skipped": 0, "bytes_saved": 0}
+
+    @staticmethod
+    def digest(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def get(self, digest: str) -> Optional[Dict]:
+        """Cached {"products", "url", "embed_bytes", "store_bytes"}; url is None until the upload succeeded."""
+        entry = self.cache.get(digest)
+        if entry is None:
+            return None
+        self.counters["searches_skipped"] += 1
+        self.counters["bytes_saved"] += entry["embed_bytes"]
+        if entry["url"]:
+            self.counters["uploads_skipped"] += 1
+            self.counters["bytes_saved"] += entry["store_bytes"]
+        return {**entry, "products": [dict(product) for product in entry["products"]]}
+
+    def put(self, digest: str, products: List[Dict], embed_bytes: int, store_bytes: int, url: Optional[str] = None):
+        self.cache.set(digest, {
+            "products": [dict(product) for product in products],
+            "url": url,
+            "embed_bytes": embed_bytes,
+            "store_bytes": store_bytes,
+        })
+
+    def mark_uploaded(self, digest: str, url: str):
+        # peek: không tính là một lần lookup
+        entry = self.cache.peek(digest)
+        if entry is not None:
+            entry["url"] = url
+
+    def stats(self) -> Dict:
+        return {**self.cache.stats(), **self.counters}
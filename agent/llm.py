@@ -0,0 +1,52 @@
+import os
+import logging
+from typing import Optional
+
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+'''
+Shared async OpenAI client.
+One AsyncOpenAI instance (and one pooled httpx transport) is shared by the router,
+the final answer call and the summarizer so that a worker can keep many completions
+in flight without blocking the event loop or re-opening TLS connections.
+'''
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+_client: Optional[openai.AsyncOpenAI] = None
+
+
+def get_llm_client() -> openai.AsyncOpenAI:
+    global _client
+    if _client is None:
+        timeout = httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        http_client = openai.DefaultAsyncHttpxClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+        _client = openai.AsyncOpenAI(
+            timeout=timeout,
+            max_retries=LLM_MAX_RETRIES,
+            http_client=http_client,
+        )
+        logger.info(
+            f"Async OpenAI client created (timeout={LLM_TIMEOUT}s, max_connections={LLM_MAX_CONNECTIONS})"
+        )
+    return _client
+
+
+async def close_llm_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
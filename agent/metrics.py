@@ -0,0 +1,92 @@
+import os
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+'''
+class StageMetrics
+Process-wide latency histograms per request stage, rendered in the Prometheus text format.
++ observe(stage, seconds)
++ render(): text for GET /metrics
+
+class StageTimer
+Per-request stage timings, observed into StageMetrics as they are recorded.
++ with timer.stage("router"): ...
++ await timer.timed("history_fetch", coroutine)
++ as_dict(): breakdown returned to the client when requested
+'''
+
+METRICS_BUCKETS = [
+    float(bucket)
+    for bucket in os.getenv("METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30").split(",")
+]
+METRIC_NAME = "agent_stage_duration_seconds"
+
+
+class StageMetrics:
+    def __init__(self, buckets: List[float] = METRICS_BUCKETS, name: str = METRIC_NAME):
+        self.buckets = sorted(buckets)
+        self.name = name
+        # stage -> [per-bucket counts..., +Inf count], sum
+        self.counts: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+
+    def observe(self, stage: str, seconds: float):
+        counts = self.counts.get(stage)
+        if counts is None:
+            counts = self.counts[stage] = [0] * (len(self.buckets) + 1)
+            self.sums[stage] = 0.0
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sums[stage] += seconds
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} Time spent in each stage of an agent request.",
+            f"# TYPE {self.name} histogram",
+        ]
+        for stage in sorted(self.counts):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + [float("inf")], self.counts[stage]):
+                cumulative += count
+                le = "+Inf" if bucket == float("inf") else repr(bucket)
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {self.sums[stage]}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> Dict:
+        return {
+            stage: {"count": sum(counts), "avg": self.sums[stage] / sum(counts) if sum(counts) else 0.0}
+            for stage, counts in self.counts.items()
+        }
+
+
+class StageTimer:
+    def __init__(self, metrics: Optional[StageMetrics] = None):
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        if self.metrics is not None:
+            self.metrics.observe(stage, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    async def timed(self, name: str, awaitable):
+        with self.stage(name):
+            return await awaitable
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> Dict[str, float]:
+        return {stage: round(seconds, 6) for stage, seconds in self.stages.items()}
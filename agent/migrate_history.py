@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+from .history import History
+
+'''
+One-off migration for ChatHistory documents written before the slim schema.
+Moves context and full product dicts into the cold collection and keeps
+[{database_id, score}] references on the hot document. Safe to re-run.
+
+    python -m agent.migrate_history
+'''
+
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    history = History()
+    try:
+        await history.ensure_indexes()
+        result = await history.migrate_legacy_documents()
+        if result.status == "success":
+            logger.info(f"Migration finished: {result.data['migrated']} documents")
+        else:
+            logger.error(f"Migration failed: {result.error}")
+    finally:
+        await history.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
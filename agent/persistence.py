@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+'''
+class PersistenceQueue
+Write-behind pipeline for finished turns, so users never wait on history or summary writes.
++ submit(user_id, response_data): record the turn in the history buffer (read-your-writes),
+  enqueue and return (only waits when the queue is full)
++ history lane: batches documents and writes them with History.add_many_to_history (insert_many)
++ summary lane: hands turns to Personalization.schedule_update (coalesced by SummaryScheduler)
++ failed history writes are retried with exponential backoff (summaries are retried by the scheduler)
++ close(): drains both lanes on shutdown
+'''
+
+PERSISTENCE_QUEUE_SIZE = int(os.getenv("PERSISTENCE_QUEUE_SIZE", "1000"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+PERSISTENCE_MAX_RETRIES = int(os.getenv("PERSISTENCE_MAX_RETRIES", "3"))
+PERSISTENCE_RETRY_BACKOFF = float(os.getenv("PERSISTENCE_RETRY_BACKOFF", "0.5"))
+PERSISTENCE_DRAIN_TIMEOUT = float(os.getenv("PERSISTENCE_DRAIN_TIMEOUT", "30"))
+
+
+class PersistenceQueue:
+    def __init__(
+        self,
+        history,
+        personalization,
+        maxsize: int = PERSISTENCE_QUEUE_SIZE,
+        batch_size: int = HISTORY_BATCH_SIZE,
+        flush_interval: float = HISTORY_FLUSH_INTERVAL,
+        max_retries: int = PERSISTENCE_MAX_RETRIES,
+        retry_backoff: float = PERSISTENCE_RETRY_BACKOFF,
+        drain_timeout: float = PERSISTENCE_DRAIN_TIMEOUT,
+        metrics=None,
+    ):
+        self.history = history
+        self.personalization = personalization
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.drain_timeout = drain_timeout
+        self.metrics = metrics
+        self.history_queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.counters = {
+            "submitted": 0,
+            "history_written": 0,
+            "history_failed": 0,
+            "summaries_scheduled": 0,
+            "summaries_failed": 0,
+            "retries": 0,
+            "queue_full_waits": 0,
+        }
+
+    def start(self):
+        if self.workers:
+            return
+        self.history_queue = asyncio.Queue(maxsize=self.maxsize)
+        self.workers = [asyncio.create_task(self._history_worker())]
+        logger.info("Persistence queue started")
+
+    async def submit(self, user_id: str, response_data: Dict):
+        self.start()
+        # Copy: the caller strips fields from response_data before returning it
+        document = dict(response_data)
+        # Turn đọc được ngay từ buffer, không chờ batch ghi Mongo
+        self.history.record_turn(document)
+        if self.history_queue.full():
+            self.counters["queue_full_waits"] += 1
+            logger.warning("Persistence queue full, applying backpressure")
+        await self.history_queue.put(document)
+        self.counters["submitted"] += 1
+
+        result = self.personalization.schedule_update(user_id, document)
+        if result.status == "success":
+            self.counters["summaries_scheduled"] += 1
+        else:
+            self.counters["summaries_failed"] += 1
+            logger.warning(f"Failed to schedule summary update for user {user_id}: {result.error}")
+
+    async def _with_retry(self, description: str, operation):
+        result = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await operation()
+                if result.status == "success":
+                    return result
+                error = result.error
+            except Exception as e:
+                error = str(e)
+            if attempt < self.max_retries:
+                self.counters["retries"] += 1
+                logger.warning(f"{description} failed ({error}), retry {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+        logger.error(f"{description} failed after {self.max_retries + 1} attempts: {error}")
+        return result
+
+    async def _history_worker(self):
+        while True:
+            batch = [await self.history_queue.get()]
+            self._collect(batch)
+            if len(batch) < self.batch_size:
+                # Chờ thêm một nhịp để gom batch lớn hơn cho insert_many
+                await asyncio.sleep(self.flush_interval)
+                self._collect(batch)
+            try:
+                start_time = time.perf_counter()
+                result = await self._with_retry(
+                    f"Saving {len(batch)} history documents",
+                    lambda: self.history.add_many_to_history(batch, update_buffer=False),
+                )
+                if self.metrics is not None:
+                    self.metrics.observe("history_write", time.perf_counter() - start_time)
+                stored = result is not None and result.status == "success"
+                self.history.settle_turns(batch, stored)
+                if stored:
+                    self.counters["history_written"] += len(batch)
+                else:
+                    self.counters["history_failed"] += len(batch)
+            finally:
+                for _ in batch:
+                    self.history_queue.task_done()
+
+    def _collect(self, batch: List[Dict]):
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.history_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    def stats(self) -> Dict:
+        return {
+            **self.counters,
+            "history_queue_depth": self.history_queue.qsize() if self.history_queue else 0,
+            "max_queue_depth": self.maxsize,
+            "summary_scheduler": self.personalization.scheduler.stats(),
+        }
+
+    async def close(self):
+        if self.workers:
+            try:
+                await asyncio.wait_for(self.history_queue.join(), timeout=self.drain_timeout)
+                logger.info("Persistence queue drained")
+            except asyncio.TimeoutError:
+                logger.error(f"Persistence queue drain timed out, dropping {self.history_queue.qsize()} history documents")
+            for worker in self.workers:
+                worker.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            self.workers = []
+        await self.personalization.close()
@@ -1,26 +1,29 @@
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
+import asyncio
 import logging
 from pydantic import BaseModel
-from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 from dotenv import load_dotenv
 from os import getenv
+from .cache import TTLCache
+from .scheduler import Slots
+from .database import MongoManager, URI
 
 load_dotenv(override=True)
 
-MONGO_USER = getenv("MONGO_USER")
-MONGO_PASSWORD = getenv("MONGO_PASSWORD")
-CONNECTION_STRING = getenv("CONNECTION_STRING")
-URI = f"mongodb+srv://{MONGO_USER}:{MONGO_PASSWORD}@{CONNECTION_STRING}"
+SUMMARY_EVERY_N_TURNS = int(getenv("SUMMARY_EVERY_N_TURNS", "5"))
+SUMMARY_MAX_DELAY = float(getenv("SUMMARY_MAX_DELAY", "60"))
+SUMMARY_MAX_PENDING_TURNS = int(getenv("SUMMARY_MAX_PENDING_TURNS", "20"))
+USER_SUMMARY_CACHE_SIZE = int(getenv("USER_SUMMARY_CACHE_SIZE", "10000"))
+USER_SUMMARY_CACHE_TTL = float(getenv("USER_SUMMARY_CACHE_TTL", "600"))
 
 
 '''
 Class Personalization
 - Khởi tạo:
-+ Client: Mongo Client
-+ DB: MongoClient[DBName]
-+ collection: db[collection name]
++ mongo: shared MongoManager (one pooled client per process)
++ collection: mongo.get_collection(DBName, collection name)
 + summarizer: chatbot
 + personalization type: UserProfile
 {
@@ -33,8 +36,9 @@ Class Personalization
 Methods:
 - Summarize_input()
 - create_user_summary (): summarize + create new record
-- retrieve_user_summary (): search for user_record by id
-- update_user_summary (): search for user record by id + update summary + update record 
+- retrieve_user_summary (): search for user_record by id (LRU+TTL cache first, Mongo on miss)
+- update_user_summary (): search for user record by id + update summary + upsert record
+- schedule_update (): queue a turn; SummaryScheduler folds queued turns into one update_user_summary
 Fails:
 - return status and traceback
 '''
@@ -63,26 +67,49 @@ def serialize_mongo_doc(doc):
     return doc
 
 class Personalization:
-    def __init__(self, uri=URI, summarizer=None):
-        try:
-            self.PERSONALIZATION_DB = PERSONALIZATION_DB
-            self.PERSONALIZATION_COLLECTION = PERSONALIZATION_COLLECTION
-            self.client = client
-            self.db = self.client[self.PERSONALIZATION_DB]
-            self.collection = self.db[self.PERSONALIZATION_COLLECTION]
-            logger.info("MongoDB (Motor) connection established successfully.")
-        except Exception as e:
-            logger.error(f"Failed to initialize MongoDB connection: {str(e)}")
-            self.client = None
+    def __init__(self, uri=URI, summarizer=None, mongo: Optional[MongoManager] = None, llm_slots: Optional[Slots] = None):
+        self.PERSONALIZATION_DB = PERSONALIZATION_DB
+        self.PERSONALIZATION_COLLECTION = PERSONALIZATION_COLLECTION
+        self.owns_mongo = mongo is None
+        self.mongo = mongo or MongoManager(uri)
         self.summarizer = summarizer
+        self.llm_slots = llm_slots or Slots("llm")
         self.personalization_type = UserProfile
         if not self.summarizer:
             logger.warning("No summarizer provided. Summarization disabled.")
+        self.scheduler = SummaryScheduler(self)
+        # Profile chỉ thay đổi qua update/create của chính service này -> cache write-through
+        self.cache = TTLCache(maxsize=USER_SUMMARY_CACHE_SIZE, ttl=USER_SUMMARY_CACHE_TTL)
+
+    def schedule_update(self, user_id: str, raw_input: Dict) -> APIResponse:
+        if not user_id:
+            return APIResponse(status="error", error="user_id cannot be empty")
+        if not raw_input:
+            return APIResponse(status="error", error="No raw_input provided")
+        pending_turns = self.scheduler.add_turn(user_id, raw_input)
+        return APIResponse(status="success", data={"user_id": user_id, "pending_turns": pending_turns})
+
+    @property
+    def collection(self):
+        return self.mongo.get_collection(self.PERSONALIZATION_DB, self.PERSONALIZATION_COLLECTION)
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("user_id")
+        logger.info("Personalization indexes ensured")
+
+    async def close(self):
+        await self.scheduler.flush_all()
+        if self.owns_mongo:
+            await self.mongo.close()
 
     async def retrieve_user_summary(self, user_id: str) -> APIResponse:
         if not user_id:
             return APIResponse(status="error", error="user_id cannot be empty")
 
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return APIResponse(status="success", data=dict(cached))
+
         try:
             document = await self.collection.find_one({"user_id": user_id})
             if not document:
@@ -90,7 +117,9 @@ class Personalization:
                 return APIResponse(status="not_found", data={})
 
             logger.info(f"Summary retrieved successfully for user {user_id}")
-            return APIResponse(status="success", data=serialize_mongo_doc(document))
+            document = serialize_mongo_doc(document)
+            self.cache.set(user_id, document)
+            return APIResponse(status="success", data=dict(document))
 
         except Exception as e:
             logger.error(f"Error retrieving summary for user {user_id}: {str(e)}")
@@ -117,6 +146,7 @@ class Personalization:
             }
 
             await self.collection.insert_one(document)
+            self.cache.set(user_id, serialize_mongo_doc(document))
             logger.info(f"Summary created successfully for user {user_id}")
             return APIResponse(status="success", data={"user_id": user_id})
 
@@ -124,48 +154,54 @@ class Personalization:
             logger.error(f"Error creating summary for user {user_id}: {str(e)}")
             return APIResponse(status="error", error="Failed to create user summary")
 
-    async def update_user_summary(self, user_id: str, raw_input: Dict) -> APIResponse:
+    async def update_user_summary(self, user_id: str, raw_input: Union[Dict, List[Dict]]) -> APIResponse:
         if not user_id:
             return APIResponse(status="error", error="user_id cannot be empty")
         if not raw_input:
             return APIResponse(status="error", error="No raw_input provided")
 
         try:
-            # Always retrieve first
+            turns = raw_input if isinstance(raw_input, list) else [raw_input]
             current_summary_response = await self.retrieve_user_summary(user_id)
+            if current_summary_response.status == "error":
+                return current_summary_response
 
-            # If not found, create empty summary first
-            if current_summary_response.status != "success" or not current_summary_response.data:
-                logger.info(f"No existing summary for user {user_id}. Creating new summary.")
-                create_result = await self.create_user_summary(user_id=user_id, raw_input=raw_input)
-                if create_result.status != "success":
-                    return create_result  # stop if create failed
-                # Now fetch fresh after creation
-                current_summary_response = await self.retrieve_user_summary(user_id)
-                if current_summary_response.status != "success" or not current_summary_response.data:
-                    return APIResponse(status="error", error="Failed to retrieve newly created summary")
-
-            current_summary = current_summary_response.data.get("summary", {})
+            # not_found: summarize from scratch and let the upsert create the record
+            current_summary = (current_summary_response.data or {}).get("summary", {})
             # logger.info(f"Current summary for user {user_id}: {current_summary}")
-            new_document = f"query: {raw_input.get('user_query', '')}\nContext: {raw_input.get('context', '')}\nResponse: {raw_input.get('response', '')}"
+            new_document = "\n\n".join(
+                f"query: {turn.get('user_query', '')}\nContext: {turn.get('context', '')}\nResponse: {turn.get('response', '')}"
+                for turn in turns
+            )
             # logger.info(f"New document for summarization: {new_document}")
             updated_summary = await self.summarize_input(raw_input=new_document, current_summary=current_summary)
             updated_summary["preferences"] = updated_summary.get("preferences", [])[:10]
             # logger.info(f"Updated summary for user {user_id}: {updated_summary}")
 
+            now = datetime.now().isoformat()
             await self.collection.update_one(
                 {"user_id": user_id},
                 {
                     "$set": {
                         "summary": updated_summary,
-                        "updated_at": datetime.now().isoformat()
-                    }
-                }
+                        "updated_at": now
+                    },
+                    "$setOnInsert": {"created_at": now}
+                },
+                upsert=True
             )
-            logger.info(f"Summary updated successfully for user {user_id}")
+            self.cache.set(user_id, {
+                "user_id": user_id,
+                "created_at": now,
+                **(current_summary_response.data or {}),
+                "summary": updated_summary,
+                "updated_at": now,
+            })
+            logger.info(f"Summary updated successfully for user {user_id} from {len(turns)} turns")
             return APIResponse(status="success", data={"user_id": user_id})
 
         except Exception as e:
+            self.cache.pop(user_id)
             logger.error(f"Error updating summary for user {user_id}: {str(e)}")
             return APIResponse(status="error", error="Failed to update user summary")
 
@@ -184,14 +220,15 @@ class Personalization:
                 f"Input: {raw_input}"
             )
 
-            response = self.summarizer.beta.chat.completions.parse(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a summarization assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format=self.personalization_type
-            )
+            async with self.llm_slots.slot():
+                response = await self.summarizer.beta.chat.completions.parse(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": "You are a summarization assistant."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    response_format=self.personalization_type
+                )
 
             result = response.choices[0].message.parsed
             summary = result.model_dump()
@@ -206,3 +243,102 @@ class Personalization:
             raise
 
 
+class SummaryScheduler:
+    """
+    Coalesce a user's turns into one summarize_input call.
+    A user's queued turns are summarized every `every_n_turns` turns or `max_delay`
+    seconds after the first queued turn, whichever comes first, and at most one
+    summary per user runs at a time so overlapping requests cannot overwrite each other.
+    """
+
+    def __init__(
+        self,
+        personalization: Personalization,
+        every_n_turns: int = SUMMARY_EVERY_N_TURNS,
+        max_delay: float = SUMMARY_MAX_DELAY,
+        max_pending_turns: int = SUMMARY_MAX_PENDING_TURNS,
+    ):
+        self.personalization = personalization
+        self.every_n_turns = every_n_turns
+        self.max_delay = max_delay
+        self.max_pending_turns = max_pending_turns
+        self.pending: Dict[str, List[Dict]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        self.flushing = False
+        self.counters = {"turns": 0, "summaries": 0, "failed": 0, "dropped_turns": 0}
+
+    def add_turn(self, user_id: str, raw_input: Dict) -> int:
+        turns = self.pending.setdefault(user_id, [])
+        turns.append(raw_input)
+        self.counters["turns"] += 1
+        self._trim(user_id)
+
+        if len(turns) >= self.every_n_turns:
+            self._trigger(user_id)
+        else:
+            self._arm_timer(user_id)
+        return len(self.pending.get(user_id, []))
+
+    def _trim(self, user_id: str):
+        turns = self.pending[user_id]
+        if len(turns) > self.max_pending_turns:
+            dropped = len(turns) - self.max_pending_turns
+            self.pending[user_id] = turns[dropped:]
+            self.counters["dropped_turns"] += dropped
+            logger.warning(f"Dropped {dropped} oldest pending summary turns for user {user_id}")
+
+    def _arm_timer(self, user_id: str):
+        if self.flushing or user_id in self.timers or user_id in self.running:
+            return
+        loop = asyncio.get_running_loop()
+        self.timers[user_id] = loop.call_later(self.max_delay, self._trigger, user_id)
+
+    def _trigger(self, user_id: str):
+        timer = self.timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if user_id in self.running or not self.pending.get(user_id):
+            # Summary đang chạy sẽ xử lý các turn mới khi xong
+            return
+        self.running[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def _run(self, user_id: str):
+        try:
+            while self.pending.get(user_id):
+                turns = self.pending.pop(user_id)
+                result = await self.personalization.update_user_summary(user_id, turns)
+                if result.status == "success":
+                    self.counters["summaries"] += 1
+                else:
+                    # Giữ lại các turn để lần sau thử lại
+                    self.counters["failed"] += 1
+                    self.pending[user_id] = turns + self.pending.get(user_id, [])
+                    self._trim(user_id)
+                    break
+                if not self.flushing and len(self.pending.get(user_id, [])) < self.every_n_turns:
+                    break
+        finally:
+            self.running.pop(user_id, None)
+            if self.pending.get(user_id):
+                self._arm_timer(user_id)
+
+    async def flush_all(self):
+        self.flushing = True
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for user_id in list(self.pending):
+            self._trigger(user_id)
+        while self.running:
+            await asyncio.gather(*list(self.running.values()), return_exceptions=True)
+        if self.pending:
+            logger.error(f"Dropping pending summary turns for {len(self.pending)} users on shutdown")
+
+    def stats(self) -> Dict:
+        return {
+            **self.counters,
+            "pending_users": len(self.pending),
+            "pending_turns": sum(len(turns) for turns in self.pending.values()),
+            "running": len(self.running),
+        }
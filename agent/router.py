@@ -0,0 +1,316 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import unicodedata
+from typing import Dict, List, Optional, Union
+
+from pydantic import BaseModel, Field
+from typing_extensions import Literal
+
+from .cache import TTLCache
+from .scheduler import Slots
+from .prompts import PROMPTS
+
+logger = logging.getLogger(__name__)
+
+'''
+class Router
+Text-track router: turns the user query (+ history and summary) into a RouterResponse.
++ route(): local RuleRouter first, then cache lookup, then the structured-output LLM call
++ cache key: normalized query, plus a hash of history/summary when the decision
+  depended on them (needs_context=False, or a query rewrite pulled from context)
+
+class RuleRouter
+Deterministic fast path for plain product searches with Vietnamese price/rating/review
+phrases ("tìm sách dưới 200k", "từ 500k đến 2 triệu", "trên 4 sao", "hơn 100 đánh giá").
+Anything ambiguous (follow-ups, FAQ/policy topics, yes/no questions, unparsed amounts)
+returns None and goes to the LLM router.
+'''
+
+RULE_ROUTER_ENABLED = os.getenv("RULE_ROUTER_ENABLED", "true").lower() in ("1", "true", "yes")
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "5000"))
+ROUTER_CACHE_TTL = float(os.getenv("ROUTER_CACHE_TTL", "900"))
+
+
+class FilterResponse(BaseModel):
+    rating_average: Optional[Dict[str, float]] = Field(
+        None, description="e.g., {'$gte': 4}", json_schema_extra={
+            "type": "object",
+            "additionalProperties": {"type": ["number", "array"]}
+        }
+    )
+    price: Optional[Dict[str, float]] = Field(
+        None, description="e.g., {'$gte': 500000, '$lte': 2000000}", json_schema_extra={
+            "type": "object",
+            "additionalProperties": {"type": ["number", "array"]}
+        }
+    )
+    review_count: Optional[Dict[str, float]] = Field(
+        None, description="e.g., {'$gte': 10}", json_schema_extra={
+            "type": "object",
+            "additionalProperties": {"type": ["number", "array"]}
+        }
+    )
+
+
+class RouterResponse(BaseModel):
+    needs_context: bool
+    intent: Optional[str] = None
+    query: Optional[str] = None
+    collection: Literal["products", "policies_FAQ", "exists"]
+    filter: Optional[FilterResponse] = None
+
+
+def normalize_query(query: Optional[str]) -> str:
+    """NFC, lowercase, punctuation to spaces (except inside numbers like 1.5), collapsed whitespace."""
+    text = unicodedata.normalize("NFC", query or "").lower()
+    text = re.sub(r"(?<!\d)[^\w\s]|[^\w\s](?!\d)", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def context_hash(chat_history: List, user_summary: Union[Dict, List]) -> str:
+    payload = json.dumps([chat_history, user_summary], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+NUMBER = r"\d+(?:[.,]\d+)*"
+# Dài trước ngắn: "triệu" trước "tr"; đơn vị không được dính chữ phía sau ("tr" != "trên")
+UNIT = r"(?:triệu|tr|củ|nghìn|ngàn|ngan|k|vnđ|vnd|đồng|đ)(?![^\W\d])"
+UNIT_MULTIPLIERS = {
+    "triệu": 1_000_000, "tr": 1_000_000, "củ": 1_000_000,
+    "nghìn": 1_000, "ngàn": 1_000, "ngan": 1_000, "k": 1_000,
+    "vnđ": 1, "vnd": 1, "đồng": 1, "đ": 1,
+}
+
+
+def _amount(name: str) -> str:
+    return rf"(?P<{name}>{NUMBER})\s*(?P<{name}_unit>{UNIT})?(?:\s*(?P<{name}_frac>\d{{1,3}})(?!\d))?"
+
+
+class RuleRouter:
+    RATING_PATTERN = re.compile(
+        r"(?:được\s+)?(?:đánh giá\s+)?(?:(?P<op>trên|từ|ít nhất|tối thiểu|dưới|hơn)\s+)?"
+        r"(?P<value>[0-5](?:[.,]\d)?)\s*sao(?:\s+trở lên)?"
+    )
+    REVIEW_PATTERN = re.compile(
+        r"(?:(?P<op>nhiều hơn|trên|hơn|từ|ít nhất|tối thiểu|dưới)\s+)?(?P<value>\d+)\s*"
+        r"(?:lượt\s+)?(?:đánh giá|nhận xét|reviews?)(?:\s+trở lên)?"
+    )
+    PRICE_RANGE_PATTERN = re.compile(
+        rf"(?:giá\s+)?(?:(?:trong\s+)?khoảng\s+|từ\s+)?{_amount('low')}\s*(?:đến|tới|-|~)\s*{_amount('high')}"
+    )
+    PRICE_BOUND_PATTERNS = [
+        (re.compile(rf"(?:giá\s+)?(?:không quá|không vượt quá|tối đa)\s+{_amount('value')}"), "$lte"),
+        (re.compile(rf"(?:giá\s+)?(?:dưới|nhỏ hơn|thấp hơn|ít hơn|rẻ hơn)\s+{_amount('value')}"), "$lt"),
+        (re.compile(rf"(?:giá\s+)?{_amount('value')}\s*(?:đổ lại|trở xuống)"), "$lte"),
+        (re.compile(rf"(?:giá\s+)?(?:ít nhất|tối thiểu)\s+{_amount('value')}(?:\s+trở lên)?"), "$gte"),
+        (re.compile(rf"(?:giá\s+)?từ\s+{_amount('value')}(?:\s+trở lên)?"), "$gte"),
+        (re.compile(rf"(?:giá\s+)?{_amount('value')}\s*trở lên"), "$gte"),
+        (re.compile(rf"(?:giá\s+)?(?:trên|lớn hơn|cao hơn|nhiều hơn|hơn)\s+{_amount('value')}"), "$gt"),
+    ]
+    SEARCH_VERB_PATTERN = re.compile(
+        r"^(?:(?:cho|giúp)\s+)?(?:(?:tôi|mình|em|tớ|anh|chị|mình cần)\s+)?(?:(?:muốn|cần|đang)\s+)?"
+        r"(?:tìm kiếm|tìm mua|tìm|kiếm|mua|xem|gợi ý)\s+"
+    )
+    CONTEXT_MARKERS = re.compile(
+        r"\b(?:đó|này|kia|nó|nãy|vừa|trước|còn|nữa|khác|thêm|hơn|vậy|trên|dưới|nào)\b"
+    )
+    FAQ_MARKERS = re.compile(
+        r"chính sách|đổi trả|trả hàng|hoàn tiền|bảo hành|giao hàng|vận chuyển|\bship|thanh toán|trả góp|"
+        r"khuyến mãi|mã giảm|voucher|đơn hàng|hủy đơn|tài khoản|policy|return|refund|shipping|\bfaq\b"
+    )
+    LEFTOVER_UNIT = re.compile(rf"\d\s*{UNIT}|\bgiá\b|\bsao\b|đánh giá")
+    FILLER_WORDS = {"có", "với", "và", "mà", "nhé", "nha", "ạ", "ak", "giùm", "giúp", "cho", "mình", "tôi", "em", "các", "những"}
+
+    def __init__(self):
+        self.counters = {"attempts": 0, "routed": 0}
+
+    def _parse_amount(self, match, name: str, inherited_unit: Optional[str] = None) -> Optional[float]:
+        number = match.group(name)
+        unit = match.group(f"{name}_unit") or inherited_unit
+        frac = match.group(f"{name}_frac")
+        multiplier = UNIT_MULTIPLIERS.get(unit, 1) if unit else 1
+
+        if multiplier >= 1_000:
+            # "1,5 triệu" / "1.5tr": dấu phân cách là phần thập phân
+            if len(re.findall(r"[.,]", number)) > 1:
+                return None
+            value = float(number.replace(",", "."))
+        else:
+            # "1.500.000đ" / "500000": dấu phân cách là hàng nghìn
+            value = float(re.sub(r"[.,]", "", number))
+            if not unit and value < 1_000:
+                return None  # "dưới 500": không rõ đơn vị
+        if frac:
+            if multiplier != 1_000_000:
+                return None
+            value += int(frac) / (10 ** len(frac))  # "1tr5" = 1.5 triệu
+        return value * multiplier
+
+    def _extract_price(self, text: str):
+        match = self.PRICE_RANGE_PATTERN.search(text)
+        if match:
+            high_unit = match.group("high_unit")
+            low = self._parse_amount(match, "low", inherited_unit=None if match.group("low_unit") else high_unit)
+            high = self._parse_amount(match, "high")
+            if low is None or high is None or low > high:
+                return None, text
+            return {"$gte": low, "$lte": high}, text[:match.start()] + " " + text[match.end():]
+
+        for pattern, operator in self.PRICE_BOUND_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                value = self._parse_amount(match, "value")
+                if value is None:
+                    return None, text
+                return {operator: value}, text[:match.start()] + " " + text[match.end():]
+        return None, text
+
+    def _extract(self, pattern, text: str, operators: Dict[Optional[str], str], max_value: Optional[float] = None):
+        match = pattern.search(text)
+        if not match:
+            return None, text
+        value = float(match.group("value").replace(",", "."))
+        if max_value is not None and value > max_value:
+            return None, text
+        operator = operators.get(match.group("op"), operators[None])
+        return {operator: value}, text[:match.start()] + " " + text[match.end():]
+
+    def parse(self, query: Optional[str]) -> Optional[Dict]:
+        text = re.sub(r"\s+", " ", unicodedata.normalize("NFC", query or "").lower()).strip(" .!")
+        if not text or "?" in text or self.FAQ_MARKERS.search(text):
+            return None
+        if re.search(r"\bcó\b.*\bkhông\b", text) or text.endswith("không"):
+            return None  # câu hỏi có/không -> check_existence, để LLM xử lý
+
+        verb = self.SEARCH_VERB_PATTERN.match(text)
+        remaining = text[verb.end():] if verb else text
+
+        filters = {}
+        # Rating/review trước price để "trên 4 sao" không bị đọc thành giá
+        # "trên N sao" -> $gte: khách thường hiểu là "từ N sao trở lên"
+        rating, remaining = self._extract(self.RATING_PATTERN, remaining, {"dưới": "$lt", None: "$gte"}, max_value=5)
+        if rating:
+            filters["rating_average"] = rating
+        reviews, remaining = self._extract(
+            self.REVIEW_PATTERN, remaining,
+            {"trên": "$gt", "hơn": "$gt", "nhiều hơn": "$gt", "dưới": "$lt", None: "$gte"},
+        )
+        if reviews:
+            filters["review_count"] = reviews
+        price, remaining = self._extract_price(remaining)
+        if price:
+            filters["price"] = price
+
+        if self.LEFTOVER_UNIT.search(remaining) or self.CONTEXT_MARKERS.search(remaining):
+            return None
+        tokens = [token for token in re.sub(r"[^\w\s.-]", " ", remaining).split() if token not in self.FILLER_WORDS]
+        if not any(re.search(r"[^\W\d]", token) for token in tokens):
+            return None
+        if not verb and (not filters or len(tokens) < 2):
+            return None
+        return {"query": " ".join(tokens), "filter": filters}
+
+    def route(self, query: Optional[str]) -> Optional[RouterResponse]:
+        self.counters["attempts"] += 1
+        parsed = self.parse(query)
+        if parsed is None:
+            return None
+        self.counters["routed"] += 1
+        return RouterResponse(
+            needs_context=True,
+            intent="search_product",
+            query=parsed["query"],
+            collection="products",
+            filter=FilterResponse(**parsed["filter"]) if parsed["filter"] else None,
+        )
+
+    def stats(self) -> Dict:
+        attempts = self.counters["attempts"]
+        return {
+            **self.counters,
+            "coverage": self.counters["routed"] / attempts if attempts else 0.0,
+        }
+
+
+class Router:
+    def __init__(
+        self,
+        chatbot,
+        model: str,
+        cache_size: int = ROUTER_CACHE_SIZE,
+        cache_ttl: float = ROUTER_CACHE_TTL,
+        use_rules: bool = RULE_ROUTER_ENABLED,
+        llm_slots: Optional[Slots] = None,
+    ):
+        self.chatbot = chatbot
+        self.llm_slots = llm_slots or Slots("llm")
+        self.model = model
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.rules = RuleRouter() if use_rules else None
+        self.counters = {"requests": 0, "rule_hits": 0, "cache_hits": 0, "llm_calls": 0}
+
+    def build_message(self, query: Optional[str], chat_history: List, user_summary: Union[Dict, List]) -> str:
+        router_message = f"Past conversations: {chat_history}\nUser summary: {user_summary}\n"
+        if query:
+            router_message += f"User query: {query}"
+        return router_message
+
+    async def route(self, query: Optional[str], chat_history: List, user_summary: Union[Dict, List]) -> RouterResponse:
+        self.counters["requests"] += 1
+        if self.rules is not None:
+            ruled = self.rules.route(query)
+            if ruled is not None:
+                self.counters["rule_hits"] += 1
+                return ruled
+
+        normalized = normalize_query(query)
+        context_key = context_hash(chat_history, user_summary)
+
+        if normalized:
+            cached = self.cache.get((normalized, None))
+            if cached is None:
+                cached = self.cache.get((normalized, context_key))
+            if cached is not None:
+                self.counters["cache_hits"] += 1
+                return cached.model_copy(deep=True)
+
+        result = await self._route_llm(self.build_message(query, chat_history, user_summary))
+
+        if normalized and result is not None:
+            key = (normalized, None) if self._is_context_free(normalized, result) else (normalized, context_key)
+            self.cache.set(key, result.model_copy(deep=True))
+        return result
+
+    async def _route_llm(self, router_message: str) -> RouterResponse:
+        self.counters["llm_calls"] += 1
+        async with self.llm_slots.slot():
+            router_completion = await self.chatbot.beta.chat.completions.parse(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": PROMPTS.TEXT_PROMPT},
+                    {"role": "user", "content": router_message}
+                ],
+                response_format = RouterResponse
+            )
+        return router_completion.choices[0].message.parsed
+
+    def _is_context_free(self, normalized: str, result: RouterResponse) -> bool:
+        # needs_context=False: câu trả lời nằm trong history/summary -> phụ thuộc context
+        if not result.needs_context:
+            return False
+        # Query viết lại chỉ dùng từ của câu hỏi hiện tại -> không lấy gì từ history
+        query_tokens = set(normalize_query(result.query).split())
+        return query_tokens <= set(normalized.split())
+
+    def stats(self) -> Dict:
+        requests = self.counters["requests"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["cache_hits"] / requests if requests else 0.0,
+            "rule_coverage": self.counters["rule_hits"] / requests if requests else 0.0,
+            "cache": self.cache.stats(),
+            "rules": self.rules.stats() if self.rules is not None else None,
+        }
@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+'''
+class RequestScheduler
+Admission control and concurrency limits for Agent requests.
++ admit(user_id): sheds load with Overloaded once too many requests are active,
+  otherwise holds the user's lock so one user's messages run in arrival order
++ admit_batch(): admits a whole batch as one active request; its items only take
+  their user lock, so a busy server never drops items of an accepted batch
++ llm / search: Slots bounding concurrent OpenAI and embedding-service calls process-wide
++ retry_after(): seconds to suggest in the 429 Retry-After header
+
+class Slots
+Semaphore with wait/in-flight counters; limit <= 0 means unlimited.
+'''
+
+SCHEDULER_MAX_LLM_CALLS = int(os.getenv("SCHEDULER_MAX_LLM_CALLS", "32"))
+SCHEDULER_MAX_SEARCH_CALLS = int(os.getenv("SCHEDULER_MAX_SEARCH_CALLS", "32"))
+SCHEDULER_MAX_ACTIVE_REQUESTS = int(os.getenv("SCHEDULER_MAX_ACTIVE_REQUESTS", "200"))
+SCHEDULER_MIN_RETRY_AFTER = int(os.getenv("SCHEDULER_MIN_RETRY_AFTER", "1"))
+SCHEDULER_MAX_RETRY_AFTER = int(os.getenv("SCHEDULER_MAX_RETRY_AFTER", "30"))
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Slots:
+    def __init__(self, name: str, limit: int = 0):
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.in_flight = 0
+        self.waiting = 0
+        self.counters = {"acquired": 0, "waited": 0, "wait_time": 0.0, "max_in_flight": 0}
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.semaphore is None:
+            yield
+            return
+        if self.semaphore.locked():
+            self.counters["waited"] += 1
+        self.waiting += 1
+        start_time = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.counters["wait_time"] += time.perf_counter() - start_time
+        self.counters["acquired"] += 1
+        self.in_flight += 1
+        self.counters["max_in_flight"] = max(self.counters["max_in_flight"], self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            **self.counters,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+        }
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        max_llm_calls: int = SCHEDULER_MAX_LLM_CALLS,
+        max_search_calls: int = SCHEDULER_MAX_SEARCH_CALLS,
+        max_active_requests: int = SCHEDULER_MAX_ACTIVE_REQUESTS,
+        min_retry_after: int = SCHEDULER_MIN_RETRY_AFTER,
+        max_retry_after: int = SCHEDULER_MAX_RETRY_AFTER,
+    ):
+        self.llm = Slots("llm", max_llm_calls)
+        self.search = Slots("search", max_search_calls)
+        self.max_active_requests = max_active_requests
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+        self.active = 0
+        self.avg_latency = 0.0
+        self.user_locks: Dict[str, asyncio.Lock] = {}
+        self.user_refs: Dict[str, int] = {}
+        self.counters = {"admitted": 0, "admitted_batches": 0, "shed": 0, "max_active": 0, "user_waits": 0}
+
+    def retry_after(self) -> int:
+        # Ước lượng thời gian để hàng đợi hiện tại chạy hết qua các LLM slot
+        parallelism = self.llm.limit if self.llm.limit > 0 else max(1, self.active)
+        estimate = math.ceil(self.avg_latency * self.active / parallelism)
+        return max(self.min_retry_after, min(self.max_retry_after, estimate))
+
+    def _shed_if_full(self):
+        if self.max_active_requests > 0 and self.active >= self.max_active_requests:
+            self.counters["shed"] += 1
+            raise Overloaded(self.retry_after())
+
+    @asynccontextmanager
+    async def admit(self, user_id: str):
+        self._shed_if_full()
+        self.active += 1
+        self.counters["admitted"] += 1
+        self.counters["max_active"] = max(self.counters["max_active"], self.active)
+        start_time = time.perf_counter()
+        try:
+            async with self.user_lock(user_id):
+                yield
+        finally:
+            self.active -= 1
+            elapsed = time.perf_counter() - start_time
+            self.avg_latency = elapsed if not self.avg_latency else 0.9 * self.avg_latency + 0.1 * elapsed
+
+    @asynccontextmanager
+    async def admit_batch(self):
+        self._shed_if_full()
+        self.active += 1
+        self.counters["admitted_batches"] += 1
+        self.counters["max_active"] = max(self.counters["max_active"], self.active)
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: str):
+        lock = self.user_locks.get(user_id)
+        if lock is None:
+            lock = self.user_locks[user_id] = asyncio.Lock()
+        self.user_refs[user_id] = self.user_refs.get(user_id, 0) + 1
+        if lock.locked():
+            self.counters["user_waits"] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.user_refs[user_id] -= 1
+            if not self.user_refs[user_id]:
+                del self.user_refs[user_id]
+                del self.user_locks[user_id]
+
+    def stats(self) -> Dict:
+        return {
+            **self.counters,
+            "active": self.active,
+            "max_active_requests": self.max_active_requests,
+            "avg_latency": self.avg_latency,
+            "retry_after": self.retry_after(),
+            "users_locked": len(self.user_locks),
+            "llm": self.llm.stats(),
+            "search": self.search.stats(),
+        }
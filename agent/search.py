@@ -0,0 +1,176 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Union
+
+import httpx
+from pydantic import BaseModel, ConfigDict
+
+from .scheduler import Slots
+
+logger = logging.getLogger(__name__)
+
+'''
+class SearchClient
+Async client for the embedding/search service.
++ one pooled httpx.AsyncClient per agent (keep-alive, bounded connections)
++ per-call timeouts
++ typed results (SearchResult / Product); failures are returned, not raised
++ search_products: filtered search with unfiltered fallback, optionally speculative
+  (both requests in flight at once, the loser is cancelled)
+'''
+
+IMAGE_EMBEDDING_URL = os.getenv("IMAGE_EMBEDDING_URL", "http://text-embedding:3002/api/v1/embedding/")
+TEXT_EMBEDDING_URL = os.getenv("TEXT_EMBEDDING_URL", "http://text-embedding:3002/api/v1/embedding/")
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "10"))
+SEARCH_CONNECT_TIMEOUT = float(os.getenv("SEARCH_CONNECT_TIMEOUT", "3"))
+SEARCH_MAX_CONNECTIONS = int(os.getenv("SEARCH_MAX_CONNECTIONS", "50"))
+SEARCH_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SEARCH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+SPECULATIVE_SEARCH = os.getenv("SPECULATIVE_SEARCH", "false").lower() in ("1", "true", "yes")
+
+
+class Product(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    name: Optional[str] = None
+    description: Optional[str] = None
+    specifications: Optional[str] = None
+    benefits: Optional[str] = None
+    price: Optional[Union[int, float]] = None
+    database_id: Optional[Union[str, int]] = None
+    score: Optional[float] = None
+
+
+class SearchResult(BaseModel):
+    status: str
+    error: Optional[str] = None
+    top_k_results: List[Product] = []
+    latency: float = 0.0
+    fallback_used: bool = False
+    # stage -> seconds: search, or search_filtered (+ search_fallback)
+    stages: Dict[str, float] = {}
+
+    def products(self) -> List[Dict]:
+        return [product.model_dump(exclude_unset=True) for product in self.top_k_results]
+
+
+class SearchClient:
+    def __init__(
+        self,
+        text_url: str = TEXT_EMBEDDING_URL,
+        image_url: str = IMAGE_EMBEDDING_URL,
+        timeout: float = SEARCH_TIMEOUT,
+        connect_timeout: float = SEARCH_CONNECT_TIMEOUT,
+        max_connections: int = SEARCH_MAX_CONNECTIONS,
+        max_keepalive_connections: int = SEARCH_MAX_KEEPALIVE_CONNECTIONS,
+        speculative: bool = SPECULATIVE_SEARCH,
+        slots: Optional[Slots] = None,
+    ):
+        self.text_url = text_url
+        self.image_url = image_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.speculative = speculative
+        self.slots = slots or Slots("search")
+        self.client = None
+        self.counters = {
+            "filtered_searches": 0,
+            "speculative_searches": 0,
+            "fallback_wins": 0,
+            "fallbacks_cancelled": 0,
+        }
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _post(self, url: str, timeout: Optional[float] = None, **kwargs) -> SearchResult:
+        start_time = time.perf_counter()
+        try:
+            async with self.slots.slot():
+                response = await self.get_client().post(
+                    url, timeout=timeout if timeout is not None else self.timeout, **kwargs
+                )
+            response.raise_for_status()
+            payload = response.json()
+            return SearchResult(
+                status="success",
+                top_k_results=payload.get("top_k_results", []),
+                latency=time.perf_counter() - start_time,
+            )
+        except httpx.TimeoutException:
+            logger.error(f"Search request to {url} timed out")
+            return SearchResult(status="error", error="Search request timed out", latency=time.perf_counter() - start_time)
+        except Exception as e:
+            logger.error(f"Search request to {url} failed: {str(e)}")
+            return SearchResult(status="error", error="Search request failed", latency=time.perf_counter() - start_time)
+
+    async def search_text(self, query: str, filter: Optional[Dict] = None, timeout: Optional[float] = None) -> SearchResult:
+        body = {"query": query}
+        if filter is not None:
+            body["filter"] = filter
+        return await self._post(self.text_url, timeout=timeout, json=body)
+
+    async def search_image(self, image_bytes: bytes, timeout: Optional[float] = None) -> SearchResult:
+        files = {
+            "image": ("image.jpg", image_bytes, "image/jpeg")
+        }
+        return await self._post(self.image_url, timeout=timeout, files=files)
+
+    async def search_products(self, query: str, filter: Optional[Dict] = None, speculative: Optional[bool] = None) -> SearchResult:
+        """Filtered text search that falls back to an unfiltered search when the filter matches nothing."""
+        if not filter:
+            result = await self.search_text(query, filter=filter)
+            result.stages = {"search": result.latency}
+            return result
+
+        speculative = self.speculative if speculative is None else speculative
+        self.counters["filtered_searches"] += 1
+        if not speculative:
+            result = await self.search_text(query, filter=filter)
+            if result.top_k_results:
+                result.stages = {"search_filtered": result.latency}
+                return result
+            logger.info("Empty search result. Proceed to search again, no filter...")
+            return self._fallback_won(result, await self.search_text(query))
+
+        self.counters["speculative_searches"] += 1
+        filtered_task = asyncio.create_task(self.search_text(query, filter=filter))
+        fallback_task = asyncio.create_task(self.search_text(query))
+        try:
+            result = await filtered_task
+            if result.top_k_results:
+                fallback_task.cancel()
+                self.counters["fallbacks_cancelled"] += 1
+                result.stages = {"search_filtered": result.latency}
+                return result
+            logger.info("Empty filtered search result. Using speculative unfiltered result...")
+            return self._fallback_won(result, await fallback_task)
+        finally:
+            for task in (filtered_task, fallback_task):
+                if not task.done():
+                    task.cancel()
+
+    def _fallback_won(self, filtered: SearchResult, result: SearchResult) -> SearchResult:
+        self.counters["fallback_wins"] += 1
+        result.fallback_used = True
+        result.stages = {"search_filtered": filtered.latency, "search_fallback": result.latency}
+        return result
+
+    def stats(self) -> Dict:
+        filtered = self.counters["filtered_searches"]
+        return {
+            **self.counters,
+            "speculative": self.speculative,
+            "fallback_rate": self.counters["fallback_wins"] / filtered if filtered else 0.0,
+        }
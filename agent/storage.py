@@ -0,0 +1,131 @@
+import os
+import uuid
+import asyncio
+import logging
+from typing import Optional, Set, Tuple
+
+import boto3
+from botocore.exceptions import BotoCoreError, NoCredentialsError, ClientError
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+'''
+class ImageUploader
++ client: one long-lived boto3 S3 client (thread-safe, shared by all requests)
+Methods
++ prepare(image_bytes, name): sniff MIME, generate the S3 key and public URL up front
++ upload(image_bytes, upload): put_object in a worker thread
++ schedule(image_bytes, upload): start the upload as a task tracked until close()
+Modes (S3_UPLOAD_MODE)
++ concurrent: upload overlaps search + answer generation, awaited before returning
++ background: response returns with the pre-computed URL, upload finishes afterwards
+'''
+
+AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
+S3_BUCKET = os.getenv("S3_BUCKET", "ezshop-bucket")
+S3_FOLDER = os.getenv("S3_FOLDER", "search-uploads")
+S3_REGION = os.getenv("S3_REGION", "ap-southeast-2")
+S3_UPLOAD_MODE = os.getenv("S3_UPLOAD_MODE", "concurrent")
+
+
+class PreparedUpload(BaseModel):
+    key: str
+    url: str
+    content_type: str
+
+
+def detect_image_type(image_bytes: bytes) -> Tuple[str, str]:
+    # Xác định MIME và extension
+    if image_bytes[:4] == b'\x89PNG':
+        return 'image/png', 'png'
+    if image_bytes[:2] == b'\xff\xd8':
+        return 'image/jpeg', 'jpg'
+    if image_bytes[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif', 'gif'
+    return 'application/octet-stream', 'bin'
+
+
+class ImageUploader:
+    def __init__(
+        self,
+        bucket_name: str = S3_BUCKET,
+        folder: str = S3_FOLDER,
+        region_name: str = S3_REGION,
+        aws_access_key_id: Optional[str] = AWS_ACCESS_KEY,
+        aws_secret_access_key: Optional[str] = AWS_SECRET_KEY,
+        mode: str = S3_UPLOAD_MODE,
+        client=None,
+    ):
+        if mode not in ("concurrent", "background"):
+            raise ValueError(f"Invalid S3 upload mode: {mode}")
+        self.bucket_name = bucket_name
+        self.folder = folder
+        self.region_name = region_name
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.mode = mode
+        self.client = client
+        self.pending: Set[asyncio.Task] = set()
+
+    @property
+    def background(self) -> bool:
+        return self.mode == "background"
+
+    def get_client(self):
+        if self.client is None:
+            self.client = boto3.client(
+                "s3",
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                region_name=self.region_name,
+            )
+        return self.client
+
+    def prepare(self, image_bytes: bytes, name: Optional[str] = None) -> PreparedUpload:
+        """name: deterministic object name (e.g. content hash); a random uuid4 by default."""
+        mime_type, file_ext = detect_image_type(image_bytes)
+        filename = f"{name or uuid.uuid4().hex}.{file_ext}"
+        s3_key = f"{self.folder.rstrip('/')}/{filename}" if self.folder else filename
+        image_url = f"https://{self.bucket_name}.s3.{self.region_name}.amazonaws.com/{s3_key}"
+        return PreparedUpload(key=s3_key, url=image_url, content_type=mime_type)
+
+    def put(self, image_bytes: bytes, upload: PreparedUpload) -> str:
+        try:
+            self.get_client().put_object(
+                Bucket=self.bucket_name,
+                Key=upload.key,
+                Body=image_bytes,
+                ContentType=upload.content_type,
+                ACL="public-read",
+            )
+            return upload.url
+
+        except NoCredentialsError:
+            raise RuntimeError("AWS credentials not provided or invalid.")
+        except ClientError as e:
+            raise RuntimeError(f"Failed to upload image: {e.response['Error']['Message']}")
+        except BotoCoreError as e:
+            # EndpointConnectionError, ReadTimeoutError, ...
+            raise RuntimeError(f"Failed to upload image: {str(e)}")
+
+    async def upload(self, image_bytes: bytes, upload: Optional[PreparedUpload] = None) -> str:
+        upload = upload or self.prepare(image_bytes)
+        return await asyncio.to_thread(self.put, image_bytes, upload)
+
+    def schedule(self, image_bytes: bytes, upload: PreparedUpload) -> asyncio.Task:
+        task = asyncio.create_task(self.upload(image_bytes, upload))
+        self.pending.add(task)
+        task.add_done_callback(self._upload_done)
+        return task
+
+    def _upload_done(self, task: asyncio.Task):
+        self.pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Image upload failed: {task.exception()}")
+
+    async def close(self):
+        if self.pending:
+            logger.info(f"Waiting for {len(self.pending)} pending image uploads")
+            await asyncio.gather(*self.pending, return_exceptions=True)
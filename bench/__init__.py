@@ -0,0 +1,4 @@
+'''
+Offline benchmark suite: fake OpenAI / embedding services, in-memory Mongo and an S3 stub,
+plus a load generator. Entry point: python -m bench.run (see bench/run.py).
+'''
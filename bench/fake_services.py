@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import asyncio
+import random
+import argparse
+import logging
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+'''
+Local stand-ins for the agent's HTTP dependencies.
++ fake OpenAI-compatible server: POST /v1/chat/completions
+  - plain, streamed (SSE) and structured (response_format=json_schema) completions
+  - structured output is generated from the requested JSON schema, so the router
+    and summarizer models parse without knowing about the fake
++ fake embedding/search service: POST /api/v1/embedding/ (JSON text query or multipart image)
+Latencies are "mean±jitter" seconds and configurable per service.
+
+    python -m bench.fake_services --llm-port 9001 --embedding-port 9002
+'''
+
+logger = logging.getLogger(__name__)
+
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.3"))
+FAKE_LLM_JITTER = float(os.getenv("FAKE_LLM_JITTER", "0.1"))
+FAKE_LLM_TOKENS = int(os.getenv("FAKE_LLM_TOKENS", "60"))
+FAKE_LLM_TOKEN_INTERVAL = float(os.getenv("FAKE_LLM_TOKEN_INTERVAL", "0.005"))
+FAKE_SEARCH_LATENCY = float(os.getenv("FAKE_SEARCH_LATENCY", "0.05"))
+FAKE_SEARCH_JITTER = float(os.getenv("FAKE_SEARCH_JITTER", "0.02"))
+FAKE_SEARCH_TOP_K = int(os.getenv("FAKE_SEARCH_TOP_K", "5"))
+
+# Giá trị mặc định cho các field string khi sinh structured output
+STRING_FIELDS = {"intent": "search_product", "collection": "products"}
+
+
+async def simulated_delay(mean: float, jitter: float):
+    await asyncio.sleep(max(0.0, random.uniform(mean - jitter, mean + jitter)))
+
+
+def sample_from_schema(schema, defs, name: str = "", query: str = ""):
+    """Smallest valid instance of a (strict) JSON schema, with readable strings."""
+    if "$ref" in schema:
+        return sample_from_schema(defs[schema["$ref"].split("/")[-1]], defs, name, query)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        # Object refs (vd filter) -> null; primitive -> giá trị
+        if options and "$ref" not in options[0] and options[0].get("type") != "object":
+            return sample_from_schema(options[0], defs, name, query)
+        return None
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == "object":
+        return {
+            key: sample_from_schema(value, defs, key, query)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return []
+    if kind == "boolean":
+        return True
+    if kind in ("number", "integer"):
+        return 0
+    if kind == "string":
+        if name == "query":
+            return query
+        return STRING_FIELDS.get(name, "benchmark")
+    return None
+
+
+def last_user_message(messages) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"]
+    return ""
+
+
+def completion_payload(model: str, content: str) -> dict:
+    return {
+        "id": f"chatcmpl-bench-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def chunk_payload(chunk_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def create_llm_app(
+    latency: float = FAKE_LLM_LATENCY,
+    jitter: float = FAKE_LLM_JITTER,
+    tokens: int = FAKE_LLM_TOKENS,
+    token_interval: float = FAKE_LLM_TOKEN_INTERVAL,
+) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "bench")
+        query = last_user_message(body.get("messages", []))
+        response_format = body.get("response_format") or {}
+
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            content = json.dumps(
+                sample_from_schema(schema, schema.get("$defs", {}), query=query.split("\n")[0][:200]),
+                ensure_ascii=False,
+            )
+            await simulated_delay(latency, jitter)
+            return JSONResponse(completion_payload(model, content))
+
+        words = [f"từ{i}" for i in range(tokens)]
+        if not body.get("stream"):
+            await simulated_delay(latency, jitter)
+            return JSONResponse(completion_payload(model, " ".join(words)))
+
+        async def events():
+            chunk_id = f"chatcmpl-bench-{random.getrandbits(32):08x}"
+            await simulated_delay(latency, jitter)
+            yield chunk_payload(chunk_id, model, {"role": "assistant", "content": ""})
+            for word in words:
+                await asyncio.sleep(token_interval)
+                yield chunk_payload(chunk_id, model, {"content": word + " "})
+            yield chunk_payload(chunk_id, model, {}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def fake_products(seed: str, top_k: int):
+    rng = random.Random(seed)
+    return [
+        {
+            "name": f"Sản phẩm {rng.randint(1, 5000)}",
+            "description": "Mô tả sản phẩm dùng cho benchmark. " * 8,
+            "specifications": "Thông số: 10 x 20 cm, 300 g",
+            "benefits": "Bảo hành 12 tháng, đổi trả 30 ngày",
+            "price": rng.randint(50, 5000) * 1000,
+            "database_id": str(rng.randint(1, 10 ** 6)),
+            "score": round(rng.uniform(0.2, 0.9), 4),
+        }
+        for _ in range(top_k)
+    ]
+
+
+def create_embedding_app(
+    latency: float = FAKE_SEARCH_LATENCY,
+    jitter: float = FAKE_SEARCH_JITTER,
+    top_k: int = FAKE_SEARCH_TOP_K,
+) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/api/v1/embedding/")
+    async def search(request: Request):
+        if request.headers.get("content-type", "").startswith("multipart/"):
+            form = await request.form()
+            image = await form["image"].read()
+            seed, query = str(len(image)), "image"
+        else:
+            body = await request.json()
+            seed, query = body.get("query") or "", body.get("query")
+        await simulated_delay(latency, jitter)
+        return {
+            "query": query,
+            "query_embedding": [],
+            "top_k_results": fake_products(seed, top_k),
+            "status": "success",
+            "latency": latency,
+        }
+
+    return app
+
+
+async def serve(llm_port: int, embedding_port: int, host: str = "127.0.0.1"):
+    servers = [
+        uvicorn.Server(uvicorn.Config(create_llm_app(), host=host, port=llm_port, log_level="warning")),
+        uvicorn.Server(uvicorn.Config(create_embedding_app(), host=host, port=embedding_port, log_level="warning")),
+    ]
+    logger.info(f"Fake OpenAI on :{llm_port}, fake embedding service on :{embedding_port}")
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the fake OpenAI and embedding services")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--llm-port", type=int, default=9001)
+    parser.add_argument("--embedding-port", type=int, default=9002)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.llm_port, args.embedding_port, args.host))
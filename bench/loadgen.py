@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import zlib
+import struct
+import random
+import asyncio
+import argparse
+import statistics
+from typing import Dict, List, Optional
+
+import httpx
+
+'''
+Closed-loop load generator for the agent endpoints.
+`concurrency` workers send `requests` requests in total (after `warmup` unmeasured ones)
+and the run is summarised as p50/p95/p99/mean/max latency in ms, requests/sec and errors.
+Results can be compared with a saved baseline; a regression is a tail latency above
+baseline * (1 + tolerance) or throughput below baseline * (1 - tolerance).
+Image requests send a fresh image each time (full preprocess + search + upload path);
+--image-repeat sets the fraction that re-sends an earlier image (content-hash cache hits).
+
+    python -m bench.loadgen --url http://127.0.0.1:8001 --endpoint text --concurrency 16 --requests 500
+'''
+
+ENDPOINTS = {
+    "text": "/api/v1/agent/get_text_response/",
+    "image": "/api/v1/agent/get_image_response/",
+}
+
+QUERIES = [
+    "Tìm tai nghe bluetooth giá dưới 500k",
+    "Sách văn học nước ngoài đánh giá trên 4 sao",
+    "Nồi chiên không dầu từ 1 triệu đến 2 triệu",
+    "Gợi ý quà tặng sinh nhật cho bạn gái",
+    "Áo khoác nam chống nước",
+    "Có sản phẩm nào giống cái tôi vừa hỏi không?",
+    "Chính sách đổi trả như thế nào?",
+    "Bàn phím cơ trên 100 đánh giá",
+]
+
+
+def tiny_png(width: int = 8, height: int = 8) -> bytes:
+    """Valid PNG without Pillow, so detect_image_type and the upload path run for real."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    raw = b"".join(b"\x00" + bytes([random.randrange(256) for _ in range(width * 3)]) for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def fetch_stages(client: httpx.AsyncClient) -> Dict:
+    try:
+        return (await client.get("/api/v1/agent/stats/")).json()["stats"].get("stages", {})
+    except Exception:
+        return {}
+
+
+def stage_delta(before: Dict, after: Dict) -> Dict:
+    """Average ms per stage over the measured window only (stats are process-lifetime)."""
+    delta = {}
+    for stage, current in after.items():
+        previous = before.get(stage, {"count": 0, "avg": 0.0})
+        count = current["count"] - previous["count"]
+        if count > 0:
+            total = current["avg"] * current["count"] - previous["avg"] * previous["count"]
+            delta[stage] = {"count": count, "avg_ms": round(total / count * 1000, 2)}
+    return delta
+
+
+class ImageSource:
+    """Distinct images, except a `repeat` fraction drawn from the ones already sent."""
+
+    def __init__(self, repeat: float = 0.0, pool_size: int = 64, seed: int = 0):
+        self.repeat = repeat
+        self.pool_size = pool_size
+        self.random = random.Random(seed)
+        self.pool: List[bytes] = []
+
+    def next(self) -> bytes:
+        if self.pool and self.random.random() < self.repeat:
+            return self.random.choice(self.pool)
+        image = tiny_png()
+        if len(self.pool) < self.pool_size:
+            self.pool.append(image)
+        return image
+
+
+async def send(client: httpx.AsyncClient, endpoint: str, index: int, users: int, images: ImageSource) -> httpx.Response:
+    data = {
+        "conversation_id": f"bench-{index}",
+        "user_id": f"bench-user-{index % users}",
+        "text": QUERIES[index % len(QUERIES)],
+    }
+    if endpoint == "image":
+        files = {"image": ("image.png", images.next(), "image/png")}
+        return await client.post(ENDPOINTS[endpoint], data=data, files=files)
+    return await client.post(ENDPOINTS[endpoint], data=data)
+
+
+async def run_load(
+    url: str,
+    endpoint: str,
+    concurrency: int,
+    requests: int,
+    warmup: int = 10,
+    users: int = 50,
+    timeout: float = 120.0,
+    image_repeat: float = 0.0,
+) -> Dict:
+    images = ImageSource(image_repeat)
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        for index in range(warmup):
+            await send(client, endpoint, index, users, images)
+        stages_before = await fetch_stages(client)
+
+        counter = iter(range(requests))
+
+        async def worker():
+            for index in counter:
+                start_time = time.perf_counter()
+                try:
+                    response = await send(client, endpoint, warmup + index, users, images)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start_time
+                if status == "200":
+                    latencies.append(elapsed)
+                else:
+                    errors[status] = errors.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - started
+
+        stages = stage_delta(stages_before, await fetch_stages(client))
+
+    milliseconds = [latency * 1000 for latency in latencies]
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "image_repeat": image_repeat,
+        "ok": len(latencies),
+        "errors": errors,
+        "wall_time_s": round(wall_time, 3),
+        "rps": round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+        "p50_ms": round(percentile(milliseconds, 50), 2),
+        "p95_ms": round(percentile(milliseconds, 95), 2),
+        "p99_ms": round(percentile(milliseconds, 99), 2),
+        "mean_ms": round(statistics.fmean(milliseconds), 2) if milliseconds else 0.0,
+        "max_ms": round(max(milliseconds), 2) if milliseconds else 0.0,
+        "stages": stages,
+    }
+
+
+def scenario_key(result: Dict) -> str:
+    return f"{result['endpoint']}@{result['concurrency']}"
+
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    previous = {scenario_key(result): result for result in baseline.get("results", [])}
+    for result in results:
+        base = previous.get(scenario_key(result))
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{scenario_key(result)} {metric}: {base[metric]} -> {result[metric]}")
+        if base["rps"] and result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{scenario_key(result)} rps: {base['rps']} -> {result['rps']}")
+    return regressions
+
+
+def load_baseline(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_json(path: str, payload: Dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def format_result(result: Dict) -> str:
+    return (
+        f"{scenario_key(result):<12} ok={result['ok']:<5} errors={sum(result['errors'].values()):<4} "
+        f"rps={result['rps']:<8} p50={result['p50_ms']:<9} p95={result['p95_ms']:<9} p99={result['p99_ms']}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive an agent endpoint and report latency percentiles")
+    parser.add_argument("--url", default="http://127.0.0.1:8001")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="text")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--image-repeat", type=float, default=0.0, help="fraction of image requests re-sending an earlier image")
+    parser.add_argument("--output", help="write the result as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(
+        args.url, args.endpoint, args.concurrency, args.requests, args.warmup, args.users, image_repeat=args.image_repeat
+    ))
+    print(format_result(result))
+    if args.output:
+        save_json(args.output, {"results": [result]})
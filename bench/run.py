@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+
+import httpx
+
+from bench.loadgen import run_load, compare, load_baseline, save_json, format_result
+
+'''
+End-to-end benchmark: starts the fake services and the agent (bench.serve) as
+subprocesses, runs every endpoint x concurrency scenario, writes the results to
+bench/results/ and compares them with bench/baselines/<name>.json.
+
+    python -m bench.run                       # compare with bench/baselines/default.json
+    python -m bench.run --save-baseline       # record a new baseline
+    python -m bench.run --endpoints text --concurrency 1 8 32 --requests 300
+
+Exit code 1 when a scenario regresses beyond --tolerance.
+'''
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def spawn(module: str, *args: str, env=None) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", module, *args],
+        cwd=REPO_DIR,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def stop(process: subprocess.Popen, timeout: float = 60.0):
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def wait_until_ready(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.5)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+async def run_scenarios(args) -> list:
+    agent_url = f"http://127.0.0.1:{args.agent_port}"
+    await wait_until_ready(f"http://127.0.0.1:{args.llm_port}/docs")
+    await wait_until_ready(f"{agent_url}/api/v1/agent/stats/")
+    results = []
+    for endpoint in args.endpoints:
+        for concurrency in args.concurrency:
+            result = await run_load(
+                agent_url, endpoint, concurrency, args.requests, args.warmup, args.users, image_repeat=args.image_repeat
+            )
+            print(format_result(result), flush=True)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline agent benchmark")
+    parser.add_argument("--endpoints", nargs="+", default=["text", "image"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--image-repeat", type=float, default=0.0, help="fraction of image requests re-sending an earlier image")
+    parser.add_argument("--baseline", default="default")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--llm-port", type=int, default=9001)
+    parser.add_argument("--embedding-port", type=int, default=9002)
+    parser.add_argument("--agent-port", type=int, default=8001)
+    args = parser.parse_args()
+
+    services = spawn("bench.fake_services", "--llm-port", str(args.llm_port), "--embedding-port", str(args.embedding_port))
+    agent = spawn(
+        "bench.serve",
+        "--port", str(args.agent_port),
+        "--llm-url", f"http://127.0.0.1:{args.llm_port}/v1",
+        "--embedding-url", f"http://127.0.0.1:{args.embedding_port}/api/v1/embedding/",
+    )
+    try:
+        results = asyncio.run(run_scenarios(args))
+    finally:
+        # Agent first: its shutdown flushes summaries and history through the fake services
+        stop(agent)
+        stop(services)
+
+    payload = {
+        "created_at": datetime.now().isoformat(),
+        "settings": {key: value for key, value in vars(args).items() if key != "save_baseline"},
+        "results": results,
+    }
+    save_json(os.path.join(BENCH_DIR, "results", f"{datetime.now():%Y%m%d-%H%M%S}.json"), payload)
+
+    baseline_path = os.path.join(BENCH_DIR, "baselines", f"{args.baseline}.json")
+    if args.save_baseline:
+        save_json(baseline_path, payload)
+        print(f"Baseline saved to {baseline_path}")
+        return 0
+
+    baseline = load_baseline(baseline_path)
+    if baseline is None:
+        print(f"No baseline at {baseline_path}; run with --save-baseline to record one")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
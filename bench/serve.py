@@ -0,0 +1,48 @@
+import os
+import argparse
+import logging
+
+import uvicorn
+
+'''
+Runs main.app with every external dependency replaced by a local stand-in:
+OpenAI and the embedding service point at bench.fake_services, Mongo is an
+InMemoryMongoClient and S3 is an S3Stub.
+
+    python -m bench.serve --port 8001 --llm-url http://127.0.0.1:9001/v1 --embedding-url http://127.0.0.1:9002/api/v1/embedding/
+'''
+
+
+def configure_environment(llm_url: str, embedding_url: str):
+    # Phải set trước khi import main: config đọc env lúc import
+    os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY") or "bench"
+    os.environ["OPENAI_BASE_URL"] = llm_url
+    os.environ["TEXT_EMBEDDING_URL"] = embedding_url
+    os.environ["IMAGE_EMBEDDING_URL"] = embedding_url
+    os.environ.setdefault("S3_BUCKET", "bench-bucket")
+    os.environ.setdefault("S3_REGION", "ap-southeast-1")
+
+
+def create_app(llm_url: str, embedding_url: str):
+    configure_environment(llm_url, embedding_url)
+    import main
+    from bench.stubs import InMemoryMongoClient, S3Stub
+
+    main.agent.mongo.client = InMemoryMongoClient()
+    main.agent.uploader.client = S3Stub()
+    return main.app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the agent against local stand-ins")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--llm-url", default="http://127.0.0.1:9001/v1")
+    parser.add_argument("--embedding-url", default="http://127.0.0.1:9002/api/v1/embedding/")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+
+    app = create_app(args.llm_url, args.embedding_url)
+    # main.py bật INFO cho root logger; log từng request làm sai số đo
+    logging.getLogger().setLevel(args.log_level.upper())
+    uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level)
@@ -0,0 +1,190 @@
+import os
+import copy
+import time
+import asyncio
+import threading
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+'''
+In-process stand-ins injected into the agent for benchmarks.
++ InMemoryMongoClient: the subset of the Motor API used by History and Personalization
+  (find/sort/limit/to_list, find_one, insert_one, insert_many, update_one with upsert,
+  create_index), injected with MongoManager(client=...)
++ S3Stub: put_object with a configurable delay, injected with ImageUploader(client=...)
+Latencies are seconds, so the stand-ins can approximate a remote round trip.
+'''
+
+FAKE_MONGO_LATENCY = float(os.getenv("FAKE_MONGO_LATENCY", "0.002"))
+FAKE_S3_LATENCY = float(os.getenv("FAKE_S3_LATENCY", "0.08"))
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def matches(document: Dict, query: Dict) -> bool:
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict) and any(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$exists" and (key in document) != bool(operand):
+                    return False
+                if op in ("$gt", "$gte", "$lt", "$lte") and value is None:
+                    return False
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+                if op == "$lt" and not value < operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(document: Dict, projection: Optional[Dict]) -> Dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = [key for key, flag in projection.items() if flag]
+    if included:
+        result = {key: document[key] for key in included if key in document}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+    else:
+        result = {key: value for key, value in document.items() if projection.get(key, 1)}
+    return copy.deepcopy(result)
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids: List):
+        self.inserted_ids = inserted_ids
+
+
+class InMemoryCursor:
+    def __init__(self, collection, query: Dict, projection: Optional[Dict]):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_key = None
+        self.sort_direction = 1
+        self.limit_count = 0
+
+    def sort(self, key: str, direction: int = 1):
+        self.sort_key, self.sort_direction = key, direction
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    async def to_list(self, length: Optional[int] = None):
+        await self.collection.delay()
+        documents = [doc for doc in self.collection.documents.values() if matches(doc, self.query)]
+        if self.sort_key:
+            documents.sort(key=lambda doc: doc.get(self.sort_key) or "", reverse=self.sort_direction < 0)
+        limit = min(filter(None, [self.limit_count, length]), default=None)
+        if limit:
+            documents = documents[:limit]
+        return [project(doc, self.projection) for doc in documents]
+
+
+class InMemoryCollection:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.documents: Dict = {}
+        self.lock = threading.Lock()
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    async def create_index(self, keys, **kwargs):
+        return "bench_index"
+
+    def find(self, query: Optional[Dict] = None, projection: Optional[Dict] = None) -> InMemoryCursor:
+        return InMemoryCursor(self, query or {}, projection)
+
+    async def find_one(self, query: Optional[Dict] = None, projection: Optional[Dict] = None):
+        documents = await InMemoryCursor(self, query or {}, projection).limit(1).to_list()
+        return documents[0] if documents else None
+
+    def _insert(self, document: Dict):
+        document.setdefault("_id", ObjectId())
+        with self.lock:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError(f"duplicate _id {document['_id']}", DUPLICATE_KEY_ERROR)
+            self.documents[document["_id"]] = copy.deepcopy(document)
+        return document["_id"]
+
+    async def insert_one(self, document: Dict):
+        await self.delay()
+        return InsertManyResult([self._insert(document)])
+
+    async def insert_many(self, documents: List[Dict], ordered: bool = True):
+        await self.delay()
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted.append(self._insert(document))
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": DUPLICATE_KEY_ERROR, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(inserted)})
+        return InsertManyResult(inserted)
+
+    async def update_one(self, query: Dict, update: Dict, upsert: bool = False):
+        await self.delay()
+        with self.lock:
+            target = next((doc for doc in self.documents.values() if matches(doc, query)), None)
+            if target is None:
+                if not upsert:
+                    return
+                target = {"_id": ObjectId(), **{k: v for k, v in query.items() if not isinstance(v, dict)}}
+                target.update(copy.deepcopy(update.get("$setOnInsert", {})))
+                self.documents[target["_id"]] = target
+            target.update(copy.deepcopy(update.get("$set", {})))
+
+
+class InMemoryDatabase:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.collections: Dict[str, InMemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = InMemoryCollection(self.latency)
+        return self.collections[name]
+
+
+class InMemoryMongoClient:
+    def __init__(self, latency: float = FAKE_MONGO_LATENCY):
+        self.latency = latency
+        self.databases: Dict[str, InMemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = InMemoryDatabase(self.latency)
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+
+class S3Stub:
+    """boto3 S3 client stand-in; put_object runs in a worker thread, so it sleeps synchronously."""
+
+    def __init__(self, latency: float = FAKE_S3_LATENCY):
+        self.latency = latency
+        self.objects: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[f"{Bucket}/{Key}"] = len(Body)
+        return {"ETag": f'"{len(Body)}"'}
@@ -1,10 +1,16 @@
 import os 
 import sys
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware  
-from typing import Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import List, Optional
+from pydantic import BaseModel
 from agent import Agent 
-import datetime 
+from agent.batch import BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS
+from agent.scheduler import Overloaded
+import time
+import json
 from fastapi.exceptions import HTTPException
 import logging
 
@@ -13,10 +19,19 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI() 
 agent = Agent() 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await agent.start()
+    yield
+    await agent.close()
+
+
+app = FastAPI(lifespan=lifespan) 
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -26,18 +41,48 @@ app.add_middleware(
 )
 
 
+def overloaded_error(action: str, error: Overloaded) -> HTTPException:
+    logger.warning(f"Shedding {action} request: {str(error)}")
+    return HTTPException(
+        status_code=429,
+        detail={
+            "action": action,
+            "status": "error",
+            "error": "Server overloaded",
+            "message": f"Too many requests in progress, retry after {error.retry_after} seconds"
+        },
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+@app.get("/api/v1/agent/stats/", summary="Get agent counters")
+async def get_stats():
+    return {
+        "action": "get_stats",
+        "status": "success",
+        "stats": agent.stats(),
+    }
+
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(agent.metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/api/v1/agent/get_text_response/", summary="Get response from agent")
 async def get_response(
     conversation_id: str = Form(...),
     user_id: str = Form(...),
     text: str = Form(...),
+    timings: bool = Form(False),
 ):
 
     print(f"Received request with conversation_id: {conversation_id}, user_id: {user_id}, text: {text}")
     try:
-        timestamp = datetime.datetime.now().isoformat()
+        start_time = time.perf_counter()
         input_data = {
             "query": text,
+            "timings": timings,
         }
 
         response = await agent.get_response(
@@ -47,8 +92,7 @@ async def get_response(
         
         logger.info(f"Response from agent: {response}")
 
-        response_time = datetime.datetime.now()
-        response["latency"] = (response_time - datetime.datetime.fromisoformat(timestamp)).total_seconds()
+        response["latency"] = time.perf_counter() - start_time
         return_data = {
             "action": "get_response",
             "status": "success",
@@ -57,6 +101,8 @@ async def get_response(
 
         return return_data
 
+    except Overloaded as oe:
+        raise overloaded_error("get_response", oe)
     except ValueError as ve:
         logger.error(f"Invalid input data: {str(ve)}")
         raise HTTPException(status_code=400, detail={
@@ -80,14 +126,16 @@ async def get_response(
     user_id: str = Form(...),
     text: str = Form(None),
     image: Optional[UploadFile] = File(...),
+    timings: bool = Form(False),
 ):
 
     print(f"Received request with conversation_id: {conversation_id}, user_id: {user_id}, text: {text}")
     try:
-        timestamp = datetime.datetime.now().isoformat()
+        start_time = time.perf_counter()
         input_data = {
             "query": text,
             "image": image,
+            "timings": timings,
         }
 
         response = await agent.get_response(
@@ -97,8 +145,7 @@ async def get_response(
         
         logger.info(f"Response from agent: {response}")
 
-        response_time = datetime.datetime.now()
-        response["latency"] = (response_time - datetime.datetime.fromisoformat(timestamp)).total_seconds()
+        response["latency"] = time.perf_counter() - start_time
         return_data = {
             "action": "get_response",
             "status": "success",
@@ -107,6 +154,8 @@ async def get_response(
 
         return return_data
 
+    except Overloaded as oe:
+        raise overloaded_error("get_response", oe)
     except ValueError as ve:
         logger.error(f"Invalid input data: {str(ve)}")
         raise HTTPException(status_code=400, detail={
@@ -122,4 +171,132 @@ async def get_response(
             "status": "error",
             "error": "Internal server error",
             "message": "An unexpected error occurred"
-        })
\ No newline at end of file
+        })
+
+
+def format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_agent_response(user_id: str, input_data: dict) -> StreamingResponse:
+    events = agent.stream_response(user_id=user_id, input_data=input_data)
+    try:
+        # Retrieval chạy trước khi trả header để lỗi input vẫn map sang 400/500
+        first_event = await events.__anext__()
+    except Overloaded as oe:
+        raise overloaded_error("stream_response", oe)
+    except ValueError as ve:
+        logger.error(f"Invalid input data: {str(ve)}")
+        raise HTTPException(status_code=400, detail={
+            "action": "stream_response",
+            "status": "error",
+            "error": "Invalid input data",
+            "message": str(ve)
+        })
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        raise HTTPException(status_code=500, detail={
+            "action": "stream_response",
+            "status": "error",
+            "error": "Internal server error",
+            "message": "An unexpected error occurred"
+        })
+
+    async def event_source():
+        try:
+            yield format_sse(first_event["event"], first_event["data"])
+            async for event in events:
+                yield format_sse(event["event"], event["data"])
+        except Exception as e:
+            logger.error(f"Streaming error for user {user_id}: {str(e)}")
+            yield format_sse("error", {
+                "status": "error",
+                "error": "Internal server error",
+                "message": "An unexpected error occurred"
+            })
+        finally:
+            # Client ngắt kết nối -> trả admission, user lock và LLM slot ngay, không chờ GC
+            await events.aclose()
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/api/v1/agent/stream_text_response/", summary="Stream response from agent (SSE)")
+async def stream_text_response(
+    conversation_id: str = Form(...),
+    user_id: str = Form(...),
+    text: str = Form(...),
+    timings: bool = Form(False),
+):
+    print(f"Received stream request with conversation_id: {conversation_id}, user_id: {user_id}, text: {text}")
+    input_data = {
+        "query": text,
+        "timings": timings,
+    }
+    return await stream_agent_response(user_id, input_data)
+
+
+@app.post("/api/v1/agent/stream_image_response/", summary="Stream response from agent (SSE)")
+async def stream_image_response(
+    conversation_id: str = Form(...),
+    user_id: str = Form(...),
+    text: str = Form(None),
+    image: UploadFile = File(...),
+    timings: bool = Form(False),
+):
+    print(f"Received stream request with conversation_id: {conversation_id}, user_id: {user_id}, text: {text}")
+    # Đọc bytes ngay vì UploadFile có thể bị đóng trước khi stream kết thúc
+    input_data = {
+        "query": text,
+        "image": await image.read(),
+        "timings": timings,
+    }
+    return await stream_agent_response(user_id, input_data)
+
+
+class BatchItem(BaseModel):
+    user_id: str
+    conversation_id: Optional[str] = None
+    text: str
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    concurrency: int = BATCH_CONCURRENCY
+    timings: bool = False
+
+
+@app.post("/api/v1/agent/batch_text_response/", summary="Answer many text queries (NDJSON stream)")
+async def batch_text_response(request: BatchRequest):
+    if not request.items or len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail={
+            "action": "batch_response",
+            "status": "error",
+            "error": "Invalid input data",
+            "message": f"items must contain between 1 and {BATCH_MAX_ITEMS} entries"
+        })
+    concurrency = max(1, min(request.concurrency, BATCH_MAX_CONCURRENCY))
+    print(f"Received batch request with {len(request.items)} items, concurrency {concurrency}")
+
+    items = [item.model_dump() for item in request.items]
+    results = agent.run_batch(items, concurrency=concurrency, timings=request.timings)
+    try:
+        # Batch được admit một lần: server quá tải -> 429 cho cả batch trước khi trả header
+        first_result = await results.__anext__()
+    except Overloaded as oe:
+        raise overloaded_error("batch_response", oe)
+
+    async def lines():
+        try:
+            yield json.dumps(first_result, ensure_ascii=False) + "\n"
+            async for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # Client ngắt kết nối -> đóng generator để huỷ item còn lại và trả admission
+            await results.aclose()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")